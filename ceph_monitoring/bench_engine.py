@@ -0,0 +1,90 @@
+"""
+Compare collect_info execution engines on a simulated cluster.
+
+No real hosts are used: every 'ssh' command is executed locally after
+a sleep, which emulates network round trip and remote command time.
+Each simulated host runs NodeResourseUsageCollector.collect_node.
+Both engines run with the same pool size, so only the engine differs.
+"""
+import sys
+import time
+import Queue
+import logging
+import argparse
+import threading
+
+import collect_info
+
+
+def fake_check_output_ssh_async(latency):
+    def check_output_ssh_async(host, opts, cmd, callback, no_retry=False, max_retry=3,
+                               input_data=None, timeout=None, label=None):
+        def finished(code, out, err):
+            callback(code == 0, out if code == 0 else out + err)
+        collect_info.run_cmd_async("sleep {0} ; {1}".format(latency, cmd), finished,
+                                   False, input_data=input_data, timeout=timeout)
+    return check_output_ssh_async
+
+
+def run_engine(engine, hosts, pool_size):
+    argv = ["collect_info", "--engine", engine, "--pool-size", str(pool_size), "--no-adaptive"]
+
+    opts = collect_info.parse_args(argv)
+    collect_info.setup_engine(opts)
+
+    res_q = Queue.Queue()
+    run_q = collect_info.CollectScheduler(collect_info.CostModel(), opts.max_host_concurrency)
+    collector = collect_info.NodeResourseUsageCollector(opts, collect_info.CollectSettings(), res_q)
+
+    for host in hosts:
+        run_q.put(collector.collect_node, "", host, {}, 'node')
+
+    max_threads = [threading.active_count()]
+    stop = threading.Event()
+
+    def count_threads():
+        while not stop.is_set():
+            max_threads[0] = max(max_threads[0], threading.active_count())
+            time.sleep(0.05)
+
+    th = threading.Thread(target=count_threads)
+    th.daemon = True
+    th.start()
+
+    t1 = time.time()
+    collect_info.run_all(opts, run_q)
+    dt = time.time() - t1
+
+    stop.set()
+    th.join()
+
+    return dt, res_q.qsize(), max_threads[0], opts.pool_size
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("--hosts", default=1000, type=int,
+                   help="Simulated host count")
+    p.add_argument("--latency", default=0.2, type=float,
+                   help="Simulated latency of each remote command, seconds")
+    p.add_argument("--pool-size", default=256, type=int,
+                   help="Pool size (max items in flight) for both engines")
+    return p.parse_args(argv[1:])
+
+
+def main(argv):
+    opts = parse_args(argv)
+    collect_info.setup_loggers(logging.WARNING)
+    collect_info.check_output_ssh_async = fake_check_output_ssh_async(opts.latency)
+    hosts = ["node-{0}".format(idx) for idx in range(opts.hosts)]
+
+    print "{0:>10s} {1:>10s} {2:>10s} {3:>10s} {4:>10s}".format(
+        "engine", "pool", "time, s", "results", "threads")
+    for engine in ("threads", "reactor"):
+        dt, results, threads, pool_size = run_engine(engine, hosts, opts.pool_size)
+        print "{0:>10s} {1:>10d} {2:>10.2f} {3:>10d} {4:>10d}".format(
+            engine, pool_size, dt, results, threads)
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv))
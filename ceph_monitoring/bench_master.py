@@ -0,0 +1,78 @@
+"""
+Compare ceph query backends on discovery and master data collection.
+
+With --fake-rados DIR no cluster is needed: 'rados' backend is served by
+local fake responder from master folder of unpacked collect_info archive.
+Without it both backends run against real cluster from --conf/--key.
+"""
+import sys
+import time
+import Queue
+import logging
+import argparse
+
+import collect_info
+
+
+def run_backend(backend, opts):
+    argv = ["collect_info", "--ceph-backend", backend,
+            "--conf", opts.conf, "--key", opts.key,
+            "--master-concurrency", str(opts.master_concurrency)]
+    if opts.fake_rados is not None:
+        argv.extend(["--fake-rados", opts.fake_rados,
+                     "--fake-rados-latency", str(opts.latency)])
+
+    ci_opts = collect_info.parse_args(argv)
+    collect_info.setup_engine(ci_opts)
+
+    t1 = time.time()
+    collect_info.CEPH_BACKEND = collect_info.make_ceph_backend(ci_opts)
+    connect_time = time.time() - t1
+
+    res_q = Queue.Queue()
+    collector = collect_info.CephDataCollector(ci_opts, collect_info.CollectSettings(), res_q)
+
+    t1 = time.time()
+    try:
+        for _ in range(opts.repeat):
+            nodes, discovered = collect_info.discover_nodes(ci_opts)
+            collector.collect_master("", None, discovered=discovered)
+    finally:
+        collect_info.CEPH_BACKEND.close()
+
+    dt = (time.time() - t1) / opts.repeat
+    failed = sum(1 for _ in range(res_q.qsize()) if not res_q.get()[0])
+    return collect_info.CEPH_BACKEND.name, connect_time, dt, failed
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("-c", "--conf", default="/etc/ceph/ceph.conf",
+                   help="Ceph cluster config file")
+    p.add_argument("-k", "--key", default="/etc/ceph/ceph.client.admin.keyring",
+                   help="Ceph cluster key file")
+    p.add_argument("--fake-rados", default=None, metavar="DIR",
+                   help="Master folder of unpacked collect_info archive for fake responder")
+    p.add_argument("--latency", default=0.05, type=float,
+                   help="Simulated latency of each fake responder command, seconds")
+    p.add_argument("--master-concurrency", default=8, type=int,
+                   help="Max count of parallel master queries")
+    p.add_argument("--repeat", default=3, type=int,
+                   help="Collect master data REPEAT times for each backend")
+    return p.parse_args(argv[1:])
+
+
+def main(argv):
+    opts = parse_args(argv)
+    collect_info.setup_loggers(logging.ERROR)
+
+    backends = ["rados"] if opts.fake_rados is not None else ["cli", "rados"]
+
+    print "{0:>10s} {1:>10s} {2:>10s} {3:>10s}".format("backend", "connect, s", "collect, s", "failed")
+    for backend in backends:
+        name, connect_time, dt, failed = run_backend(backend, opts)
+        print "{0:>10s} {1:>10.2f} {2:>10.2f} {3:>10d}".format(name, connect_time, dt, failed)
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv))
@@ -196,6 +196,9 @@ class CephCluster(object):
         self.jstorage = jstorage
         self.settings = TabulaRasa()
 
+        # resource usage of collection commands on hosts, None for old archives
+        self.collection_cost = None
+
     def get_alive_osd(self):
         # try to find alive osd
         for osd in self.osds:
@@ -218,6 +221,7 @@ class CephCluster(object):
 
         self.fill_io_devices_usage_stats()
         self.fill_net_devices_usage_stats()
+        self.collection_cost = self.jstorage.get('collection_cost')
 
         data = self.storage.get('master/collected_at')
         assert data is not None
@@ -421,19 +425,6 @@ class CephCluster(object):
             osd.osd_perf = find(self.jstorage.master.osd_perf["osd_perf_infos"],
                                 lambda x: x['id'] == osd.id)["perf_stats"]
 
-            data = self.storage.get('osd/{0}/osd_daemons'.format(osd.id))
-            if data is None:
-                osd.daemon_runs = None
-            else:
-                for line in data.split("\n"):
-                    if 'ceph-osd' in line and '-i {0}'.format(osd.id) in line:
-                        osd.daemon_runs = True
-                        break
-                else:
-                    osd.daemon_runs = False
-
-            data = self.storage.get('osd/{0}/osd_daemons'.format(osd.id))
-
             if self.sum_per_osd is not None:
                 osd.pg_count = self.sum_per_osd[osd.id]
             else:
@@ -448,6 +439,29 @@ class CephCluster(object):
         if need_set_child:
             self.set_osd_childs()
 
+        host_daemons = {}
+        for osd in self.osds:
+            osd.daemon_runs = self.osd_daemon_runs(osd, host_daemons)
+
+    def osd_daemon_runs(self, osd, host_daemons):
+        """True/False from ceph_daemons process snapshot of osd host, old archives
+        have only osd_daemons ps text, None if unknown. host_daemons - cache of snapshots"""
+        host = getattr(osd, 'host', None)
+        if host not in host_daemons:
+            host_daemons[host] = None if host is None else \
+                self.jstorage.get('hosts/{0}/ceph_daemons'.format(host))
+
+        daemons = host_daemons[host]
+        if daemons is not None:
+            return any(proc['daemon'] == 'osd' and proc['osd_id'] == osd.id for proc in daemons)
+
+        data = self.storage.get('osd/{0}/osd_daemons'.format(osd.id))
+        if data is None:
+            return None
+
+        osd_re = re.compile(r"(-i\s+|--id[\s=]+|--name\s+osd\.){0}\b".format(osd.id))
+        return any('ceph-osd' in line and osd_re.search(line) for line in data.split("\n"))
+
     def load_pools(self):
         self.pools = {}
 
@@ -3,17 +3,31 @@ import sys
 import time
 import json
 import uuid
+import zlib
 import Queue
+import pipes
+import errno
+import bisect
 import shutil
+import select
+import signal
 import socket
+import heapq
+import hashlib
 import logging
 import os.path
+import tarfile
+import resource
 import argparse
+import functools
+import tempfile
 import warnings
 import datetime
+import cStringIO
 import threading
 import subprocess
 import collections
+import multiprocessing
 
 
 logger = logging.getLogger('collect')
@@ -33,20 +47,461 @@ class CollectSettings(object):
         return True
 
 
-def check_output(cmd, log=True):
+class CmdRun(object):
+    def __init__(self, proc, input_data):
+        self.proc = proc
+        self.input_data = input_data
+        self.input_pos = 0
+        self.out = []
+        self.err = []
+        self.chunks = {proc.stdout.fileno(): self.out, proc.stderr.fileno(): self.err}
+        # stdin is closed after all input is written, so keep its number
+        self.stdin_fd = None if proc.stdin is None else proc.stdin.fileno()
+        self.open_fds = 0
+        # call_later entry of timeout kill, cancelled when process exits
+        self.kill_timer = None
+        self.code = None
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.done = threading.Event()
+
+    def result(self):
+        return self.code, "".join(self.out), "".join(self.err)
+
+    def add_done_callback(self, func):
+        """func(code, out, err) is called from reactor thread right after process exit,
+        or immediately, if it's already finished. func must not wait for other commands"""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(func)
+                return
+        func(*self.result())
+
+    def finish(self, code, error=None):
+        self.code = code
+        if error is not None:
+            self.err.append(error)
+
+        with self.lock:
+            self.done.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for func in callbacks:
+            try:
+                func(*self.result())
+            except Exception:
+                logger.exception("In command completion callback")
+
+    def wait(self):
+        self.done.wait()
+        return self.result()
+
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, 9)
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+class ProcessReactor(object):
+    """Event loop, which drives pipes of all child processes from one thread.
+
+    All reads, writes and timeout kills are done by poll() loop and command
+    completion is reported via callbacks, so neither running command nor
+    its timeout needs a thread. Timers (call_later) run in loop thread too.
+    If loop iteration fails, all running commands are killed and failed.
+    """
+    read_size = 65536
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.fds = {}
+        self.exiting = []
+        # all not finished runs, new_runs - not registered yet ones
+        self.lock = threading.Lock()
+        self.runs = set()
+        self.new_runs = collections.deque()
+        # heap of [time, seq, func, args], cancelled timers have func None
+        self.timers = []
+        self.new_timers = collections.deque()
+        self.timer_seq = 0
+        self.cancelled_timers = 0
+        self.wake_r, self.wake_w = os.pipe()
+        self.poller.register(self.wake_r, select.POLLIN)
+
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, cmd, input_data=None, timeout=None):
+        "timeout - kill process with all children (it's started in new process group) after timeout seconds"
+        proc = subprocess.Popen(cmd, shell=True,
+                                stdin=None if input_data is None else subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True,
+                                preexec_fn=os.setpgrp if timeout is not None else None)
+        crun = CmdRun(proc, input_data)
+        if timeout is not None:
+            crun.kill_timer = [time.time() + timeout, None, self.kill, (crun,)]
+        with self.lock:
+            self.runs.add(crun)
+            self.new_runs.append(crun)
+        if crun.kill_timer is not None:
+            self.new_timers.append(crun.kill_timer)
+        os.write(self.wake_w, 'x')
+        return crun
+
+    def in_loop(self):
+        "True if called from loop thread, e.g. from command callback"
+        return threading.current_thread() is self.thread
+
+    def call_later(self, delay, func, *args):
+        "call func(*args) from loop thread after delay seconds, func must not block"
+        self.new_timers.append([time.time() + delay, None, func, args])
+        os.write(self.wake_w, 'x')
+
+    def cancel_timer(self, timer):
+        """drop func and args of timer, so it doesn't keep them till its time, loop thread only.
+        Heap is rebuilt, when most of its timers are cancelled"""
+        if timer[2] is None:
+            return
+        timer[2:] = [None, ()]
+        self.cancelled_timers += 1
+        if self.cancelled_timers > len(self.timers) // 2:
+            self.timers = [entry for entry in self.timers if entry[2] is not None]
+            heapq.heapify(self.timers)
+            self.cancelled_timers = 0
+
+    def finish(self, crun, code, error=None):
+        if crun.kill_timer is not None:
+            self.cancel_timer(crun.kill_timer)
+        crun.finish(code, error)
+
+    @staticmethod
+    def kill(crun):
+        if not crun.done.is_set():
+            kill_process_group(crun.proc)
+
+    def register(self, crun):
+        for pipe in (crun.proc.stdout, crun.proc.stderr):
+            self.fds[pipe.fileno()] = crun
+            self.poller.register(pipe.fileno(), select.POLLIN)
+            crun.open_fds += 1
+
+        if crun.proc.stdin is not None:
+            self.fds[crun.proc.stdin.fileno()] = crun
+            self.poller.register(crun.proc.stdin.fileno(), select.POLLOUT)
+            crun.open_fds += 1
+
+    def close_fd(self, fd):
+        crun = self.fds.pop(fd)
+        self.poller.unregister(fd)
+        crun.open_fds -= 1
+        if crun.stdin_fd == fd:
+            crun.proc.stdin.close()
+
+        if crun.open_fds == 0:
+            crun.proc.stdout.close()
+            crun.proc.stderr.close()
+            self.exiting.append(crun)
+
+    def write_input(self, fd, crun):
+        # poll guarantees that at least PIPE_BUF bytes can be written without blocking
+        block = crun.input_data[crun.input_pos: crun.input_pos + select.PIPE_BUF]
+        try:
+            crun.input_pos += os.write(fd, block)
+        except OSError as exc:
+            if exc.errno != errno.EPIPE:
+                raise
+            crun.input_pos = len(crun.input_data)
+
+        if crun.input_pos >= len(crun.input_data):
+            self.close_fd(fd)
+
+    def poll_timeout(self):
+        "poll timeout in ms, None to wait for events only"
+        timeout = None
+        if self.timers:
+            timeout = max(int((self.timers[0][0] - time.time()) * 1000) + 1, 0)
+        if self.exiting:
+            # process can close its pipes before exit, so poll for it exit status
+            timeout = 10 if timeout is None else min(timeout, 10)
+        return timeout
+
+    def loop(self):
+        while True:
+            try:
+                self.step()
+            except Exception as exc:
+                logger.exception("In process reactor loop, fail all running commands")
+                self.fail_all(exc)
+
+    def step(self):
+        for fd, event in self.poller.poll(self.poll_timeout()):
+            if fd == self.wake_r:
+                os.read(self.wake_r, self.read_size)
+                with self.lock:
+                    new_runs = list(self.new_runs)
+                    self.new_runs.clear()
+                map(self.register, new_runs)
+                while self.new_timers:
+                    timer = self.new_timers.popleft()
+                    timer[1] = self.timer_seq
+                    heapq.heappush(self.timers, timer)
+                    self.timer_seq += 1
+                continue
+
+            crun = self.fds[fd]
+            if fd == crun.stdin_fd:
+                self.write_input(fd, crun)
+            else:
+                data = os.read(fd, self.read_size)
+                if data:
+                    crun.chunks[fd].append(data)
+                else:
+                    self.close_fd(fd)
+
+        for crun in self.exiting[:]:
+            if crun.proc.poll() is not None:
+                self.exiting.remove(crun)
+                with self.lock:
+                    self.runs.discard(crun)
+                self.finish(crun, crun.proc.returncode)
+
+        ctime = time.time()
+        while self.timers and self.timers[0][0] <= ctime:
+            _, _, func, args = heapq.heappop(self.timers)
+            if func is None:
+                self.cancelled_timers = max(self.cancelled_timers - 1, 0)
+                continue
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("In reactor timer")
+
+    def fail_all(self, exc):
+        "kill and fail all commands, start over with empty state"
+        with self.lock:
+            cruns = self.runs
+            self.runs = set()
+            self.new_runs.clear()
+
+        for fd in self.fds:
+            self.poller.unregister(fd)
+        self.fds = {}
+        self.exiting = []
+
+        for crun in cruns:
+            try:
+                # commands without timeout don't have own process group
+                if crun.proc.poll() is None:
+                    crun.proc.kill()
+                kill_process_group(crun.proc)
+                for pipe in (crun.proc.stdin, crun.proc.stdout, crun.proc.stderr):
+                    if pipe is not None:
+                        pipe.close()
+                crun.proc.wait()
+            except Exception:
+                logger.exception("Can't stop process %s", crun.proc.pid)
+            self.finish(crun, None, "\nProcess reactor failure: {0}\n".format(exc))
+
+
+# This variable is updated from main function
+REACTOR = None
+
+
+# This variable is updated from main function
+# time.time() value, when collection must be finished
+DEADLINE = None
+
+
+def limit_timeout(timeout=None):
+    "returns timeout for new command, limited by collection deadline"
+    if DEADLINE is not None:
+        left = max(DEADLINE - time.time(), 0)
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+class Tracer(object):
+    """Timeline of collection: commands, collection items, queue waits and archive
+    writes as spans, saved into archive as trace.json in Chrome trace event format,
+    which can be opened in chrome://tracing or Perfetto.
+
+    Each span gets args of its call and context of collection item, which
+    runs in the same thread: host, collector and path.
+    """
+    # max length of command in span args
+    max_cmd_len = 200
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        self.thread_names = {}
+        # events of other tracers, e.g. of relays, each in own process
+        self.merged = []
+
+    def set_context(self, **ctx):
+        self.local.ctx = ctx
+
+    def add(self, name, cat, t1, t2, **args):
+        span_args = getattr(self.local, 'ctx', {}).copy()
+        span_args.update(args)
+        if 'cmd' in span_args:
+            span_args['cmd'] = span_args['cmd'][:self.max_cmd_len]
+
+        thread = threading.current_thread()
+        span = {'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': thread.ident,
+                'ts': int((t1 - self.t0) * 1e6), 'dur': int((t2 - t1) * 1e6), 'args': span_args}
+
+        with self.lock:
+            self.spans.append(span)
+            self.thread_names[thread.ident] = thread.name
+
+    def dumps(self):
+        with self.lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}}
+                      for tid, name in self.thread_names.items()]
+            events.extend(self.spans)
+            events.extend(self.merged)
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+    def merge(self, data, t_start, process_name, **args):
+        """add events of other tracer dumps() as separate process, which started at t_start.
+        args are set to spans, which have them missing or None"""
+        shift = int((t_start - self.t0) * 1e6)
+        events = json.loads(data)['traceEvents']
+        for event in events:
+            if event['ph'] == 'X':
+                event['ts'] += shift
+                for key, val in args.items():
+                    if event['args'].get(key) is None:
+                        event['args'][key] = val
+
+        with self.lock:
+            pid = 2 + sum(1 for event in self.merged if event['name'] == 'process_name')
+            for event in events:
+                event['pid'] = pid
+            self.merged.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                                'args': {'name': process_name}})
+            self.merged.extend(events)
+
+    def log_summary(self, top=10):
+        with self.lock:
+            spans = self.spans[:]
+
+        per_host = collections.defaultdict(lambda: [0, 0])
+        for span in spans:
+            if span['cat'] == 'item' and span['args'].get('host') is not None:
+                per_host[span['args']['host']][0] += span['dur']
+                per_host[span['args']['host']][1] += 1
+
+        if len(per_host) != 0:
+            logger.info("Slowest hosts (total time of collection items):")
+            for host, (dur, count) in sorted(per_host.items(), key=lambda x: -x[1][0])[:top]:
+                logger.info("    %-30s %8.1fs %5d items", host, dur / 1e6, count)
+
+        cmds = [span for span in spans if span['cat'] in ('ssh', 'ceph')]
+        if len(cmds) != 0:
+            logger.info("Slowest commands:")
+            for span in sorted(cmds, key=lambda x: -x['dur'])[:top]:
+                logger.info("    %-30s %8.1fs %s", span['args'].get('host', '-'),
+                            span['dur'] / 1e6, span['name'][:80])
+
+
+TRACER = Tracer()
+
+
+def call_later(delay, func, *args):
+    "call func(*args) after delay seconds: from reactor thread or, with threads engine, right here"
+    if REACTOR is not None:
+        REACTOR.call_later(delay, func, *args)
+    else:
+        time.sleep(delay)
+        func(*args)
+
+
+def call_sync(func, *args, **kwargs):
+    "call func(*args, callback=..., **kwargs), wait till callback is called and return its arguments"
+    res = []
+    done = threading.Event()
+
+    def callback(*cb_args):
+        res.append(cb_args)
+        done.set()
+
+    func(*args, callback=callback, **kwargs)
+    done.wait()
+    return res[0]
+
+
+def run_cmd_async(cmd, callback, log=True, input_data=None, timeout=None):
+    """run cmd and call callback(exit code, stdout, stderr), when it's finished.
+    With reactor engine callback is called from reactor thread and must not wait
+    for other commands, with threads engine - before run_cmd_async returns.
+    timeout - kill command with all children after timeout seconds, limited by DEADLINE"""
     if log:
         logger.debug("CMD: %r", cmd)
 
+    timeout = limit_timeout(timeout)
+    if timeout is not None and timeout <= 0:
+        callback(None, "", "Collection deadline reached, command not started")
+        return
+
+    t1 = time.time()
+
+    def finished(code, out, err):
+        t2 = time.time()
+        dt = t2 - t1
+        if timeout is not None and code == -9 and dt >= timeout:
+            err += "\nKilled by timeout after {0:.1f}s\n".format(dt)
+
+        TRACER.add(cmd.split(" ", 1)[0], 'cmd', t1, t2, cmd=cmd, code=code, bytes=len(out) + len(err))
+        callback(code, out, err)
+
+    if REACTOR is not None:
+        REACTOR.run(cmd, input_data, timeout).add_done_callback(finished)
+        return
+
     p = subprocess.Popen(cmd, shell=True,
+                         stdin=None if input_data is None else subprocess.PIPE,
                          stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    out = p.communicate()
+                         stderr=subprocess.PIPE,
+                         close_fds=True,
+                         preexec_fn=os.setpgrp if timeout is not None else None)
+
+    if timeout is not None:
+        killer = threading.Timer(timeout, kill_process_group, (p,))
+        killer.daemon = True
+        killer.start()
+
+    out, err = p.communicate(input_data)
     code = p.wait()
 
+    if timeout is not None:
+        killer.cancel()
+
+    finished(code, out, err)
+
+
+def run_cmd(cmd, log=True, input_data=None, timeout=None):
+    """returns (exit code, stdout, stderr),
+    timeout - kill command with all children after timeout seconds, limited by DEADLINE"""
+    return call_sync(run_cmd_async, cmd, log=log, input_data=input_data, timeout=timeout)
+
+
+def check_output(cmd, log=True, input_data=None, timeout=None):
+    code, out, err = run_cmd(cmd, log, input_data, timeout)
     if 0 == code:
-        return True, out[0]
+        return True, out
     else:
-        return False, out[0] + out[1]
+        return False, out + err
 
 
 # This variable is updated from main function
@@ -54,47 +509,963 @@ SSH_OPTS = "-o LogLevel=quiet -o StrictHostKeyChecking=no -o UserKnownHostsFile=
 SSH_OPTS += "-o ConnectTimeout={0}"
 
 
-def check_output_ssh(host, opts, cmd, no_retry=False, max_retry=3):
+class SSHConnectionPool(object):
+    """Keeps one persistent multiplexed (ControlMaster) ssh connection per host.
+
+    Master connection is opened by open(), all following ssh/scp calls
+    reuse it via ControlPath, so only one TCP connection and key exchange
+    is made per host. If master dies ssh silently falls back to a new
+    direct connection.
+    """
+    # master exits by itself after this idle time, even if close() was never called
+    persist_timeout = 600
+
+    def __init__(self):
+        # unix socket path is limited to ~100 chars, so keep it short
+        self.ctl_dir = tempfile.mkdtemp(prefix="cm_ssh_")
+        self.masters = {}
+        self.lock = threading.Lock()
+        self.handshakes_saved = 0
+
+    def ctl_path(self, host):
+        return os.path.join(self.ctl_dir, hashlib.md5(host).hexdigest()[:16])
+
+    def open(self, host, ssh_opts, cmd='pwd'):
+        "connect to host, run cmd over new master connection and keep it alive"
+        ctl_path = self.ctl_path(host)
+        master_opts = "-o ControlMaster=yes -o ControlPersist={0} -o ControlPath={1}".format(
+            self.persist_timeout, ctl_path)
+        ok, out = check_output("ssh {0} {1} {2} {3}".format(ssh_opts, master_opts, host, cmd))
+        if ok:
+            with self.lock:
+                self.masters[host] = ctl_path
+        return ok, out
+
+    def ssh_opts(self, host):
+        "options to reuse master connection, empty string if there is no master for host"
+        with self.lock:
+            ctl_path = self.masters.get(host)
+            if ctl_path is None:
+                return ""
+            self.handshakes_saved += 1
+        return "-o ControlMaster=no -o ControlPath={0}".format(ctl_path)
+
+    def close(self):
+        with self.lock:
+            masters = self.masters.items()
+            self.masters = {}
+
+        for host, ctl_path in masters:
+            ok, out = check_output("ssh -o ControlPath={0} -O exit {1}".format(ctl_path, host))
+            if not ok:
+                logger.warning("Failed to close ssh master connection to %s: %s", host, out.strip())
+
+        shutil.rmtree(self.ctl_dir, ignore_errors=True)
+        logger.info("SSH pool: %s master connections, %s handshakes saved",
+                    len(masters), self.handshakes_saved)
+
+
+# This variable is updated from main function
+SSH_POOL = None
+
+
+def ssh_host_opts(host):
+    if SSH_POOL is None:
+        return SSH_OPTS
+    return SSH_OPTS + " " + SSH_POOL.ssh_opts(host)
+
+
+class Unavailable(str):
+    "output for command, which wasn't run, as required tool or sudo isn't available on host"
+
+
+class UnchangedResult(object):
+    """Result, which is the same as in base archive of incremental run, so its data isn't stored
+
+    validated_at - time, when remote output was checked against md5 of base result,
+    None if result was reused from base without any check
+    """
+    def __init__(self, md5, validated_at=None):
+        self.md5 = md5
+        self.validated_at = validated_at
+
+
+# admin tools are often in sbin dirs, which aren't in PATH of non-root ssh sessions,
+# commands are run and probed with them added
+TOOLS_PATH = "/sbin:/usr/sbin:/usr/local/sbin"
+
+
+class HostCapabilities(object):
+    """Optional tools and passwordless sudo availability on hosts
+
+    Hosts are probed once when ssh connection is checked, results are
+    kept in file between runs and reprobed after ttl seconds
+    """
+    optional_tools = ['ethtool', 'iwconfig', 'hdparm', 'smartctl', 'lshw',
+                      'dmidecode', 'netstat', 'lsblk', 'screen', 'ip']
+
+    probe_cmd = ("'PATH=$PATH:" + TOOLS_PATH + " ; " +
+                 "for tool in {0} ; do command -v $tool >/dev/null 2>&1 && echo tool $tool ; done ; " +
+                 "sudo -n true </dev/null >/dev/null 2>&1 && echo sudo ; true'").format(
+                    " ".join(optional_tools))
+
+    def __init__(self, fname=None, ttl=24 * 3600):
+        self.fname = fname
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # {host: {'tools': [tool], 'sudo': bool, 'probed_at': time}}
+        self.caps = {}
+
+        if fname is not None and os.path.exists(fname):
+            try:
+                self.caps = json.load(open(fname))
+            except (IOError, ValueError) as exc:
+                logger.warning("Can't load host capabilities from %r: %s", fname, exc)
+
+    def need_probe(self, host):
+        with self.lock:
+            caps = self.caps.get(host)
+        return caps is None or time.time() - caps['probed_at'] > self.ttl
+
+    def add_probe_result(self, host, out):
+        caps = {'tools': [], 'sudo': False, 'probed_at': time.time()}
+        for line in out.split("\n"):
+            items = line.split()
+            if items == ['sudo']:
+                caps['sudo'] = True
+            elif len(items) == 2 and items[0] == 'tool':
+                caps['tools'].append(items[1])
+
+        missing = sorted(set(self.optional_tools) - set(caps['tools']))
+        if missing or not caps['sudo']:
+            logger.info("Host %s: no passwordless sudo: %s, missing tools: %s",
+                        host, not caps['sudo'], ",".join(missing))
+
+        with self.lock:
+            self.caps[host] = caps
+
+    def unavailable(self, host, cmd):
+        "returns reason, why cmd can't succeed on host or None"
+        with self.lock:
+            caps = self.caps.get(host)
+
+        if caps is None:
+            return None
+
+        for word in re.split(r"[\s|;&()]+", cmd):
+            if word == 'sudo' and not caps['sudo']:
+                return "No passwordless sudo on host {0}".format(host)
+            if word in self.optional_tools and word not in caps['tools']:
+                return "{0} is not installed on host {1}".format(word, host)
+        return None
+
+    def save(self):
+        if self.fname is None:
+            return
+
+        try:
+            with self.lock:
+                data = json.dumps(self.caps, indent=4, sort_keys=True)
+            open(self.fname, "w").write(data)
+        except IOError as exc:
+            logger.warning("Can't save host capabilities to %r: %s", self.fname, exc)
+
+
+# This variable is updated from main function
+HOST_CAPS = None
+
+
+# ssh exit code for connection and authentication errors,
+# other codes are returned by remote command
+SSH_TRANSPORT_ERROR = 255
+
+
+class HostCircuitBreaker(object):
+    """Marks host as unreachable after max_failures ssh transport errors in a row,
+    all following ssh commands to this host fail immediately"""
+    def __init__(self, max_failures):
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        self.failures = collections.defaultdict(lambda: 0)
+        self.broken = set()
+
+    def is_open(self, host):
+        return host in self.broken
+
+    def success(self, host):
+        with self.lock:
+            self.failures[host] = 0
+
+    def failure(self, host):
+        "register transport error, returns True if host is marked as unreachable"
+        with self.lock:
+            self.failures[host] += 1
+            if self.failures[host] >= self.max_failures and host not in self.broken:
+                logger.error("Host %s is unreachable after %s ssh failures in a row, " +
+                             "skip all following commands on it", host, self.failures[host])
+                self.broken.add(host)
+            return host in self.broken
+
+
+# This variable is updated from main function
+HOST_BREAKER = None
+
+
+class SSHErrors(object):
+    "Counts ssh transport errors per host, congestion signal for AIMDLimiter"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.defaultdict(lambda: 0)
+        self.total = 0
+
+    def add(self, host):
+        with self.lock:
+            self.counts[host] += 1
+            self.total += 1
+
+    def get(self, host=None):
+        "errors on host, on all hosts if host is None"
+        with self.lock:
+            return self.total if host is None else self.counts.get(host, 0)
+
+
+SSH_ERRORS = SSHErrors()
+
+
+def check_output_ssh_async(host, opts, cmd, callback, no_retry=False, max_retry=3, input_data=None,
+                           timeout=None, label=None):
+    """Run cmd on host and call callback(ok, out), see run_cmd_async about callback thread.
+    Commands without input_data are executed with remote watchdog, which kills
+    whole remote process tree after timeout (opts.cmd_timeout by default) seconds.
+    For others only local ssh is killed after timeout, if it's set.
+    label - what cmd does for logs, e.g. commands of batch script, cmd by default"""
     if no_retry:
         max_retry = 0
 
-    logger.debug("SSH:%s: %r", host, cmd)
-    while True:
-        ok, res = check_output("ssh {0} {1} {2}".format(SSH_OPTS, host, cmd), False)
+    if input_data is None:
+        check_output_ssh_batch_async(host, opts, [cmd], lambda results: callback(*results[0]),
+                                     timeout=timeout, max_retry=max_retry)
+        return
+
+    if HOST_BREAKER is not None and HOST_BREAKER.is_open(host):
+        callback(False, "Host {0} is unreachable, command skipped".format(host))
+        return
+
+    if label is None:
+        label = repr(cmd)
+
+    logger.debug("SSH:%s: %s", host, label)
+
+    def attempt(retries):
+        t1 = time.time()
+
+        def finished(code, out, err):
+            TRACER.add("ssh " + host, 'transport', t1, time.time(), host=host, cmd=cmd, code=code,
+                       retries=retries, bytes=len(out) + len(err))
+
+            if code == 0:
+                if HOST_BREAKER is not None:
+                    HOST_BREAKER.success(host)
+                callback(True, out)
+                return
+
+            # only transport errors are retried: remote command errors
+            # (no such file, permission denied, ...) would fail again,
+            # killed by timeout command would most likely hang again
+            if code != SSH_TRANSPORT_ERROR:
+                callback(False, out + err)
+                return
+
+            SSH_ERRORS.add(host)
+
+            if HOST_BREAKER is not None and HOST_BREAKER.failure(host):
+                callback(False, out + err)
+                return
+
+            if retries >= max_retry:
+                callback(False, out + err)
+                return
+
+            logger.warning("Retry SSH:%s: %s", host, label)
+            call_later(1, attempt, retries + 1)
+
+        run_cmd_async("ssh {0} {1} {2}".format(ssh_host_opts(host), host, cmd), finished, False,
+                      input_data=input_data, timeout=timeout)
+
+    attempt(0)
+
+
+def check_output_ssh(host, opts, cmd, no_retry=False, max_retry=3, input_data=None, timeout=None):
+    "returns (ok, out), see check_output_ssh_async"
+    return call_sync(check_output_ssh_async, host, opts, cmd, no_retry=no_retry, max_retry=max_retry,
+                     input_data=input_data, timeout=timeout)
+
+
+# every command runs as background job in own process group (set -m),
+# watchdog kills whole group if command isn't finished in time limit,
+# which is also limited by left collection time.
+# Resource usage of command is difference of batch shell counters for waited
+# children before and after it: CPU ticks from /proc/$$/stat and disk IO from
+# /proc/$$/io. Max RSS is measured by GNU time, if host has it, -1 otherwise
+batch_prologue = """set -m
+PATH=$PATH:""" + TOOLS_PATH + """
+tmp_dir=$(mktemp -d)
+clk_tck=$(getconf CLK_TCK 2>/dev/null || echo 100)
+gnu_time=$(type -P time)
+$gnu_time --version 2>&1 | grep -q GNU || gnu_time=
+rusage() {
+    local stat=( $(</proc/$$/stat) ) rd=0 wr=0 key val
+    if [ -r /proc/$$/io ] ; then
+        while read key val ; do
+            case $key in read_bytes:) rd=$val ;; write_bytes:) wr=$val ;; esac
+        done </proc/$$/io
+    fi
+    echo $(( stat[15] + stat[16] )) $rd $wr
+}
+run_measured() {
+    if [ -n "$gnu_time" ] ; then
+        $gnu_time -f %M -o $tmp_dir/rss bash -c "$1"
+    else
+        bash -c "$1"
+    fi
+}
+wait_limited() {
+    local limit=$(( budget - SECONDS ))
+    [ $limit -gt $2 ] && limit=$2
+    [ $limit -lt 1 ] && limit=1
+    ( sleep $limit ; touch $tmp_dir/timeout ; kill -9 -$1 ) >/dev/null 2>&1 &
+    local killer=$!
+    wait $1
+    local code=$?
+    kill -9 -$killer
+    wait $killer
+    if [ -f $tmp_dir/timeout ] ; then
+        rm -f $tmp_dir/timeout
+        return 124
+    fi
+    return $code
+} 2>/dev/null
+send_result() {
+    local before=( $usage_before ) after=( $(rusage) ) rss=-1
+    [ -s $tmp_dir/rss ] && rss=$(tail -n 1 $tmp_dir/rss)
+    rm -f $tmp_dir/rss
+    case "$rss" in ''|*[!0-9]*) rss=-1 ;; esac
+    local usage="$(( (after[0] - before[0]) * 1000 / clk_tck )) $rss $(( after[1] - before[1] )) $(( after[2] - before[2] ))"
+    if [ $2 -eq 0 ] && [ "$3" != "-" ] && [ "$(md5sum <$tmp_dir/out | cut -d' ' -f1)" = "$3" ] ; then
+        echo $marker $1 $2 0 0 -1 $usage
+        return
+    fi
+    local size=$(wc -c <$tmp_dir/out)
+    local orig_size=0
+    if [ $size -gt $compress_threshold ] && gzip -c $tmp_dir/out >$tmp_dir/out.gz 2>/dev/null ; then
+        mv $tmp_dir/out.gz $tmp_dir/out
+        orig_size=$size
+    fi
+    echo $marker $1 $2 $(wc -c <$tmp_dir/out) $(wc -c <$tmp_dir/err) $orig_size $usage
+    cat $tmp_dir/out $tmp_dir/err
+}
+export -f $(compgen -A function)
+"""
+
+batch_cmd_templ = """usage_before=$(rusage)
+run_measured {cmd} </dev/null >$tmp_dir/out 2>$tmp_dir/err &
+wait_limited $! {timeout}
+send_result {idx} $? {md5}
+"""
+
+
+class TransferStats(object):
+    "Accounts traffic, saved by remote compression of command outputs"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outputs = 0
+        self.compressed = 0
+        self.orig_bytes = 0
+        self.recv_bytes = 0
+
+    def add(self, recv_size, orig_size=None):
+        with self.lock:
+            self.outputs += 1
+            self.recv_bytes += recv_size
+            if orig_size is None:
+                self.orig_bytes += recv_size
+            else:
+                self.compressed += 1
+                self.orig_bytes += orig_size
+
+    def log(self):
+        logger.info("Remote compression: %s of %s outputs compressed, %s bytes received " +
+                    "instead of %s, %s bytes saved", self.compressed, self.outputs,
+                    self.recv_bytes, self.orig_bytes, self.orig_bytes - self.recv_bytes)
+
+
+TRANSFER_STATS = TransferStats()
+
+
+class RemoteUsage(object):
+    """CPU time, max RSS and disk IO of remote commands, measured on hosts
+
+    Totals are kept per host and per command, with numbers in command
+    replaced by N, so commands for different osd's and devices are summed
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.commands = {}
+
+    @staticmethod
+    def new_totals():
+        return {'count': 0, 'cpu_ms': 0, 'max_rss_kb': None, 'read_bytes': 0, 'write_bytes': 0}
+
+    def add(self, host, cmd, cpu_ms, rss_kb, read_bytes, write_bytes):
+        cmd_key = re.sub(r"\d+", "N", cmd)[:100]
+        with self.lock:
+            for totals in (self.hosts.setdefault(host, self.new_totals()),
+                           self.commands.setdefault(cmd_key, self.new_totals())):
+                totals['count'] += 1
+                totals['cpu_ms'] += cpu_ms
+                totals['read_bytes'] += read_bytes
+                totals['write_bytes'] += write_bytes
+                if rss_kb >= 0:
+                    totals['max_rss_kb'] = max(totals['max_rss_kb'], rss_kb)
+
+    def dumps(self):
+        with self.lock:
+            return json.dumps({'hosts': self.hosts, 'commands': self.commands})
+
+    def merge(self, data):
+        "add totals from dumps() output of other run, e.g. relay"
+        with self.lock:
+            for own, other in ((self.hosts, data['hosts']), (self.commands, data['commands'])):
+                for key, totals in other.items():
+                    own_totals = own.setdefault(str(key), self.new_totals())
+                    for name in ('count', 'cpu_ms', 'read_bytes', 'write_bytes'):
+                        own_totals[name] += totals[name]
+                    own_totals['max_rss_kb'] = max(own_totals['max_rss_kb'], totals['max_rss_kb'])
+
+    def log(self):
+        with self.lock:
+            totals = self.hosts.values()
+            logger.info("Remote collection cost: %s commands on %s hosts, %.1fs CPU, " +
+                        "%s bytes read and %s bytes written to disks",
+                        sum(host['count'] for host in totals), len(totals),
+                        sum(host['cpu_ms'] for host in totals) / 1000.0,
+                        sum(host['read_bytes'] for host in totals),
+                        sum(host['write_bytes'] for host in totals))
+
+
+REMOTE_USAGE = RemoteUsage()
+
+# exit code of batch command, killed by watchdog
+BATCH_TIMEOUT_CODE = 124
+
+# time limit for commands, if neither timeout nor deadline is set
+NO_TIMEOUT = 10 ** 6
+
+# compress threshold to disable remote compression
+NO_COMPRESS = 2 ** 62
+
+
+def check_output_ssh_batch_async(host, opts, cmds, callback, prologue="", timeout=None, known_md5=None,
+                                 max_retry=3):
+    """Run all cmds in one remote shell, call callback([(ok, out)]) with results in the same order,
+    see run_cmd_async about callback thread.
+
+    Every command output is framed with a header line
+    '<marker> <cmd index> <exit code> <stdout size> <stderr size> <orig stdout size>
+    <cpu ms> <max rss KiB> <disk read bytes> <disk write bytes>',
+    followed by stdout and stderr bodies, so outputs may contain anything.
+    stdout, bigger than opts.compress_threshold bytes, is gzipped on remote side,
+    orig stdout size is 0 for not compressed outputs.
+    prologue is executed before commands, e.g. to define shell functions.
+    timeout - time limit for each command, opts.cmd_timeout by default.
+    known_md5 - md5 of expected output (or None) for each command. Output with
+    the same md5 isn't transferred, UnchangedResult is returned for it and
+    orig stdout size is -1 in header.
+    max_retry - how many times whole batch is retried after ssh transport error.
+    """
+    if len(cmds) == 0:
+        callback([])
+        return
+
+    if timeout is None:
+        timeout = getattr(opts, 'cmd_timeout', None)
+
+    results = [(False, "No output")] * len(cmds)
+
+    # commands, which can't succeed on this host, are not sent
+    run_idx = []
+    for idx, cmd in enumerate(cmds):
+        reason = None if HOST_CAPS is None else HOST_CAPS.unavailable(host, cmd)
+        if reason is None:
+            run_idx.append(idx)
+        else:
+            results[idx] = (False, Unavailable(reason))
+
+    if len(run_idx) == 0:
+        callback(results)
+        return
+
+    # all commands are limited by collection deadline, whole batch - only by deadline
+    budget = limit_timeout()
+    if budget is not None and budget <= 0:
+        for idx in run_idx:
+            results[idx] = (False, "Collection deadline reached, command not started")
+        callback(results)
+        return
+
+    # remote watchdog should fire before local ssh is killed at deadline,
+    # so already finished commands results are not lost
+    remote_budget = NO_TIMEOUT if budget is None else max(int(budget) - 1, 1)
+    cmd_limit = min(int(timeout or NO_TIMEOUT), remote_budget)
 
-        if ok or max_retry <= 0:
-            return ok, res
-	
-	if "command not found" in res:
-	    return False, res
+    compress_threshold = getattr(opts, 'compress_threshold', None)
+    if compress_threshold is None or compress_threshold < 0:
+        compress_threshold = NO_COMPRESS
 
-        max_retry -= 1
-        time.sleep(1)
-        logger.warning("Retry SSH:%s: %r", host, cmd)
+    marker = uuid.uuid4().hex
+    script = prologue + '\nbudget={0}\nmarker={1}\ncompress_threshold={2}\n'.format(
+        remote_budget, marker, compress_threshold) + batch_prologue
+    for idx in run_idx:
+        md5 = '-' if known_md5 is None or known_md5[idx] is None else known_md5[idx]
+        script += batch_cmd_templ.format(cmd=pipes.quote(cmds[idx]), idx=idx, timeout=cmd_limit, md5=md5)
+    script += 'rm -rf $tmp_dir\nexit 0\n'
+
+    t1 = time.time()
+
+    def finished(ok, data):
+        TRACER.add(cmds[run_idx[0]] if len(run_idx) == 1 else "batch of {0} commands".format(len(run_idx)),
+                   'ssh', t1, time.time(), host=host, cmd="\n".join(cmds[idx] for idx in run_idx),
+                   commands=len(run_idx), ok=ok, bytes=len(data))
+        if not ok:
+            for idx in run_idx:
+                results[idx] = (False, data)
+        else:
+            try:
+                parse_batch_output(host, cmds, known_md5, cmd_limit, marker, data, results)
+            except Exception as exc:
+                logger.exception("Can't parse batch output from %s", host)
+                for idx in run_idx:
+                    results[idx] = (False, "Broken batch output: {0}".format(exc))
+        callback(results)
+
+    label = "batch of {0} commands: {1}".format(len(run_idx), ", ".join(repr(cmds[idx]) for idx in run_idx))
+    check_output_ssh_async(host, opts, "bash -s", finished, input_data=script, timeout=budget,
+                           max_retry=max_retry, label=label)
+
+
+def parse_batch_output(host, cmds, known_md5, cmd_limit, marker, data, results):
+    """put (ok, out) of each command from batch output data into results.
+    Parsing stops at broken or truncated frame, results of the rest commands are left as is"""
+    pos = 0
+    while pos < len(data):
+        eol = data.find("\n", pos)
+        header = data[pos:eol].split()
+        if eol == -1 or len(header) != 10 or header[0] != marker or \
+                not all(re.match(r"-?\d+$", field) for field in header[1:]):
+            logger.warning("Broken batch output from %s at offset %s", host, pos)
+            break
+
+        idx, code, out_sz, err_sz, orig_sz = map(int, header[1:6])
+        out_start = eol + 1
+        err_start = out_start + out_sz
+        if not 0 <= idx < len(cmds) or out_sz < 0 or err_sz < 0 or err_start + err_sz > len(data):
+            logger.warning("Broken or truncated batch output frame from %s at offset %s", host, pos)
+            break
+
+        REMOTE_USAGE.add(host, cmds[idx], *map(int, header[6:]))
+        pos = err_start + err_sz
+
+        out = data[out_start:err_start]
+        err = data[err_start:pos]
+        if orig_sz == -1 and (known_md5 is None or known_md5[idx] is None):
+            logger.warning("Unexpected unchanged output of %r from %s", cmds[idx], host)
+            results[idx] = (False, "Output is reported unchanged, but no base md5 was given")
+            continue
+        elif orig_sz == -1:
+            TRANSFER_STATS.add(0)
+            results[idx] = (True, UnchangedResult(known_md5[idx], time.time()))
+            continue
+        elif orig_sz != 0:
+            TRANSFER_STATS.add(out_sz, orig_sz)
+            try:
+                out = zlib.decompress(out, 16 + zlib.MAX_WBITS)
+            except zlib.error as exc:
+                logger.warning("Broken compressed output of %r from %s: %s", cmds[idx], host, exc)
+                results[idx] = (False, "Can't decompress output: {0}\n{1}".format(exc, err))
+                continue
+        else:
+            TRANSFER_STATS.add(out_sz)
+
+        if code == 0:
+            results[idx] = (True, out)
+        elif code == BATCH_TIMEOUT_CODE:
+            logger.warning("SSH:%s: %r killed by timeout after %ss", host, cmds[idx], cmd_limit)
+            results[idx] = (False, out + err + "\nKilled by timeout after {0}s\n".format(cmd_limit))
+        else:
+            results[idx] = (False, out + err)
+
+
+def check_output_ssh_batch(host, opts, cmds, prologue="", timeout=None, known_md5=None, max_retry=3):
+    "returns [(ok, out)], see check_output_ssh_batch_async"
+    return call_sync(check_output_ssh_batch_async, host, opts, cmds, prologue=prologue, timeout=timeout,
+                     known_md5=known_md5, max_retry=max_retry)[0]
 
 
-def get_device_for_file(host, opts, fname):
-    ok, dev_str = check_output_ssh(host, opts, "df " + fname)
-    assert ok
+class CephCLIBackend(object):
+    """Run ceph queries with 'ceph' and 'rados' command line tools"""
+    name = 'cli'
 
-    dev_str = dev_str.strip()
-    dev_link = dev_str.strip().split("\n")[1].split()[0]
+    def __init__(self, opts):
+        self.opts = opts
+        self.ceph_cmd = "ceph -c {0.conf} -k {0.key} --format json ".format(opts)
 
-    # This sets the right fname if the journal is a raw device. Ubuntu returns 'udev', while in SUSE 'devtmpfs' is returned
-    if dev_link == 'udev' or dev_link == "devtmpfs":
-        dev_link = fname
+    def query(self, cmd):
+        "run ceph command, like 'osd tree', returns (ok, out)"
+        if cmd == 'rados df':
+            return check_output("rados df -c {0.conf} -k {0.key} --format json".format(self.opts))
 
-    abs_path_cmd = '\'path="{0}" ;'.format(dev_link)
-    abs_path_cmd += 'while [ -h "$path" ] ; do path=$(readlink "$path") ;'
-    abs_path_cmd += ' path=$(readlink -f "$path") ; done ; echo $path\''
-    ok, dev = check_output_ssh(host, opts, abs_path_cmd)
-    assert ok
-    logger.info("dev = %s", dev)
-    root_dev = dev = dev.strip()
-    while root_dev[-1].isdigit():
-        root_dev = root_dev[:-1]
+        if cmd != 'osd getcrushmap':
+            return check_output(self.ceph_cmd + cmd)
 
-    return root_dev, dev
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            out_file = os.tempnam()
+
+        try:
+            ok, out = check_output(self.ceph_cmd + "osd getcrushmap -o " + out_file)
+            if ok:
+                out = open(out_file, "rb").read()
+            return ok, out
+        finally:
+            if os.path.exists(out_file):
+                os.unlink(out_file)
+
+    def close(self):
+        pass
+
+
+class CephRadosBackend(CephCLIBackend):
+    """Send ceph queries as mon_command/mgr_command over one librados connection
+
+    Commands, which are not mon/mgr commands (rados df), are executed with CLI
+    """
+    name = 'rados'
+
+    # command line -> mon command arguments, for commands which differ
+    cmd_args = {
+        'health detail': {'prefix': 'health', 'detail': 'detail'},
+    }
+
+    def __init__(self, opts, cluster=None):
+        CephCLIBackend.__init__(self, opts)
+        if cluster is None:
+            import rados
+            cluster = rados.Rados(conffile=opts.conf, conf={'keyring': opts.key})
+            cluster.connect(timeout=opts.ssh_conn_timeout)
+        self.cluster = cluster
+
+    def query(self, cmd):
+        if cmd == 'rados df':
+            return CephCLIBackend.query(self, cmd)
+
+        args = dict(self.cmd_args.get(cmd, {'prefix': cmd}))
+        args['format'] = 'json'
+        args = json.dumps(args)
+
+        ret, out, err = self.cluster.mon_command(args, b'')
+        if ret in (-errno.EINVAL, -errno.ENOTSUP) and hasattr(self.cluster, 'mgr_command'):
+            # command is served by mgr in new ceph versions
+            ret, out, err = self.cluster.mgr_command(args, b'')
+
+        if ret != 0:
+            return False, "{0}: {1}".format(os.strerror(-ret), err)
+        return True, out
+
+    def close(self):
+        self.cluster.shutdown()
+
+
+class FakeRadosCluster(object):
+    """Local responder with rados.Rados interface for tests and benchmarks
+
+    Serves mon/mgr commands from the master folder of unpacked collect_info
+    archive, 'osd tree' from osd_tree.json, 'health detail' from
+    health_detail.json, 'osd getcrushmap' from crushmap.bin
+    """
+    def __init__(self, data_dir, latency=0):
+        self.data_dir = data_dir
+        self.latency = latency
+        self.calls = 0
+
+    def mon_command(self, cmd, inbuf, timeout=0, target=None):
+        self.calls += 1
+        time.sleep(self.latency)
+
+        args = json.loads(cmd)
+        name = args['prefix'].replace(" ", "_")
+        if name == 'osd_getcrushmap':
+            name = 'crushmap'
+        elif 'detail' in args:
+            name += "_detail"
+
+        for ext in ('json', 'bin', 'txt'):
+            fname = os.path.join(self.data_dir, name + "." + ext)
+            if os.path.exists(fname):
+                return 0, open(fname, "rb").read(), ""
+
+        return -errno.EINVAL, b"", "no fake data for command {0!r}".format(args['prefix'])
+
+    mgr_command = mon_command
+
+    def shutdown(self):
+        pass
+
+
+def make_ceph_backend(opts):
+    "returns ceph backend, selected by opts, CLI backend if librados is not usable"
+    if opts.ceph_backend == 'rados':
+        try:
+            if opts.fake_rados is not None:
+                return CephRadosBackend(opts, FakeRadosCluster(opts.fake_rados, opts.fake_rados_latency))
+            return CephRadosBackend(opts)
+        except Exception as exc:
+            logger.warning("Can't use librados backend: %s. Fallback to ceph CLI", exc)
+    return CephCLIBackend(opts)
+
+
+# This variable is updated from main function
+CEPH_BACKEND = None
+
+
+def ceph_query(opts, cmd):
+    "run ceph query with backend, selected in main"
+    backend = CEPH_BACKEND if CEPH_BACKEND is not None else CephCLIBackend(opts)
+    return backend.query(cmd)
+
+
+ceph_daemon_types = {
+    'ceph-osd': 'osd',
+    'ceph-mon': 'mon',
+    'ceph-mds': 'mds',
+    'ceph-mgr': 'mgr',
+    'radosgw': 'rgw',
+}
+
+
+class ProcessSnapshot(object):
+    """Process table of a host, parsed from 'ps -eo pid,args' output.
+
+    Every process is a dict with pid, args, daemon (ceph daemon type or None)
+    and osd_id (from '--id N', '--id=N', '-i N' or '--name osd.N' option)
+    """
+    ps_cmd = "ps -eo pid,args"
+
+    def __init__(self, ok, ps_out):
+        self.ok = ok
+        self.error = None if ok else ps_out
+        self.processes = []
+
+        if not ok:
+            return
+
+        for line in ps_out.strip().split("\n")[1:]:
+            items = line.split(None, 1)
+            if len(items) != 2 or not items[0].isdigit():
+                continue
+
+            args = items[1]
+            params = args.split()
+            daemon = ceph_daemon_types.get(os.path.basename(params[0]))
+
+            osd_id = None
+            if daemon == 'osd':
+                for opt, val in zip(params[1:], params[2:] + [None]):
+                    if opt.startswith('--id='):
+                        val = opt[len('--id='):]
+                    elif opt in ('-n', '--name') and val is not None and val.startswith('osd.'):
+                        val = val[len('osd.'):]
+                    elif opt not in ('-i', '--id'):
+                        continue
+
+                    if val is not None and val.isdigit():
+                        osd_id = int(val)
+                        break
+
+            self.processes.append({'pid': int(items[0]),
+                                   'args': args,
+                                   'daemon': daemon,
+                                   'osd_id': osd_id})
+
+    def daemons(self, daemon_type=None):
+        "ceph daemon processes, all types if daemon_type is None"
+        return [proc for proc in self.processes
+                if proc['daemon'] is not None and daemon_type in (None, proc['daemon'])]
+
+    def osd_running(self, osd_id):
+        return any(proc['osd_id'] == osd_id for proc in self.daemons('osd'))
+
+    def daemons_text(self, daemon_type):
+        "ps-like 'pid args' lines for daemons of given type"
+        return "".join("{0} {1}\n".format(proc['pid'], proc['args'])
+                       for proc in self.daemons(daemon_type))
+
+
+class ProcessSnapshots(object):
+    """Process snapshots cache, one 'ps' run per host for each collection phase"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.snapshots = {}
+
+    def get(self, host, opts):
+        with self.lock:
+            host_lock = self.host_locks.setdefault(host, threading.Lock())
+
+        with host_lock:
+            if host not in self.snapshots:
+                ok, out = check_output_ssh(host, opts, ProcessSnapshot.ps_cmd)
+                if not ok:
+                    logger.warning("Can't get process list on node %s: %s", host, out.strip())
+                self.snapshots[host] = ProcessSnapshot(ok, out)
+            return self.snapshots[host]
+
+    def add(self, host, ok, ps_out):
+        "put snapshot, taken by other way (e.g. by agent), to cache"
+        snapshot = ProcessSnapshot(ok, ps_out)
+        with self.lock:
+            self.snapshots[host] = snapshot
+        return snapshot
+
+    def reset(self):
+        "start new collection phase"
+        with self.lock:
+            self.snapshots = {}
+
+
+PROCESS_SNAPSHOTS = ProcessSnapshots()
+
+
+class HostDeviceIndex(object):
+    """Block device topology of a host.
+
+    Built from one scan of /sys/block and /proc/self/mountinfo, maps any
+    (symlink resolved) path to its partition, whole disk, rotational flag
+    and holders. Whole disk is taken from sysfs, so partitions like
+    nvme0n1p1 or mmcblk0p2 are handled correctly.
+    """
+
+    scan_cmd = """cat /proc/self/mountinfo | sed 's/^/mount /'
+for disk in /sys/block/* ; do
+    echo disk $(basename $disk) $(cat $disk/dev) - $(cat $disk/queue/rotational) $(ls $disk/holders | tr '\\n' ,)
+    for part in $disk/*/partition ; do
+        [ -e "$part" ] || continue
+        part=$(dirname $part)
+        echo part $(basename $part) $(cat $part/dev) $(basename $disk) - $(ls $part/holders | tr '\\n' ,)
+    done
+done"""
+
+    def __init__(self, scan_out):
+        self.mounts = []
+        self.devs = {}
+        self.dev_by_num = {}
+
+        for line in scan_out.split("\n"):
+            items = line.split()
+            if len(items) == 0:
+                continue
+
+            if items[0] == 'mount':
+                # mountinfo: id parent_id major:minor root mount_point ...
+                mount_point = re.sub(r"\\([0-7]{3})", lambda mobj: chr(int(mobj.group(1), 8)), items[5])
+                self.mounts.append((mount_point, items[3]))
+            elif items[0] in ('disk', 'part') and len(items) >= 5:
+                name, dev_num, disk, rotational = items[1:5]
+                self.devs[name] = {'disk': name if disk == '-' else disk,
+                                   'rotational': rotational,
+                                   'holders': [holder for holder in ",".join(items[5:]).split(",") if holder]}
+                self.dev_by_num[dev_num] = name
+
+        # the longest mount point first, later mount hides earlier one on the same point
+        self.mounts.reverse()
+        self.mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+
+    def find_device(self, real_path):
+        if real_path.startswith('/dev/'):
+            return os.path.basename(real_path)
+
+        for mount_point, dev_num in self.mounts:
+            if real_path == mount_point or real_path.startswith(mount_point.rstrip('/') + '/'):
+                return self.dev_by_num.get(dev_num)
+
+        return None
+
+    def resolve(self, real_path):
+        "device info for file or block device, None if it isn't located on known block device"
+        name = self.find_device(real_path)
+        if name not in self.devs:
+            return None
+
+        dev = self.devs[name]
+        disk = self.devs[dev['disk']]
+        return {'dev': '/dev/' + name,
+                'root_dev': '/dev/' + dev['disk'],
+                'is_ssd': disk['rotational'] == '0',
+                'holders': dev['holders']}
+
+
+class Completion(object):
+    """Returned by collection item, which isn't finished, when its function returns.
+
+    Item runs its commands with callbacks and calls done(), when all its
+    results are emitted, so worker thread doesn't wait for it. Continuations
+    should be wrapped with guard(), so exception in them finishes item.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ok = None
+        self.callbacks = []
+        self.finished = threading.Event()
+
+    def add_callback(self, func):
+        "func(ok) is called, when item is done, or immediately, if it's already done"
+        with self.lock:
+            if self.ok is None:
+                self.callbacks.append(func)
+                return
+        func(self.ok)
+
+    def done(self, ok=True):
+        with self.lock:
+            if self.ok is not None:
+                return
+            self.ok = ok
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        self.finished.set()
+        for func in callbacks:
+            func(ok)
+
+    def guard(self, func):
+        "wrap continuation: exception in it is logged and fails item"
+        def wrapper(*args):
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("In collection item callback")
+                self.done(False)
+        return wrapper
+
+    def wait(self):
+        self.finished.wait()
+        return self.ok
+
+
+def wait_item(res):
+    "wait for item function result, if it's Completion"
+    if isinstance(res, Completion):
+        res.wait()
 
 
 class Collector(object):
@@ -120,10 +1491,58 @@ class Collector(object):
             if not self.collect_settings.allowed(path):
                 return
         ok, out = check_output_ssh(host, self.opts, cmd)
+        self.emit_ssh_result(host, path, format, cmd, ok, out)
+
+    def ssh2emit_batch(self, host, items, check=True, known_md5=None):
+        """items - list of (path, format, cmd), all cmds executed in one ssh session
+        known_md5 - {path: md5 of base result}, unchanged outputs aren't transferred"""
+        if check:
+            items = [item for item in items if self.collect_settings.allowed(item[0])]
+
+        if known_md5 is not None:
+            known_md5 = [known_md5.get(path) for path, _, _ in items]
+
+        results = self.run_ssh_batch(host, [cmd for _, _, cmd in items], known_md5=known_md5)
+        for (path, format, cmd), (ok, out) in zip(items, results):
+            self.emit_ssh_result(host, path, format, cmd, ok, out)
+
+    def ssh2emit_batch_async(self, host, items, callback, check=True, known_md5=None):
+        "same as ssh2emit_batch, but callback() is called, when all results are emitted"
+        if check:
+            items = [item for item in items if self.collect_settings.allowed(item[0])]
+
+        if known_md5 is not None:
+            known_md5 = [known_md5.get(path) for path, _, _ in items]
+
+        def finished(results):
+            for (path, format, cmd), (ok, out) in zip(items, results):
+                self.emit_ssh_result(host, path, format, cmd, ok, out)
+            callback()
+
+        if self.opts.no_batch:
+            finished([check_output_ssh(host, self.opts, cmd) for _, _, cmd in items])
+        else:
+            check_output_ssh_batch_async(host, self.opts, [cmd for _, _, cmd in items], finished,
+                                         known_md5=known_md5)
+
+    def run_ssh_batch(self, host, cmds, prologue="", known_md5=None):
+        "run cmds in one ssh session, unless batching is disabled, returns [(ok, out)]"
+        if not self.opts.no_batch:
+            return check_output_ssh_batch(host, self.opts, cmds, prologue, known_md5=known_md5)
+
+        if prologue == "":
+            return [check_output_ssh(host, self.opts, cmd) for cmd in cmds]
+
+        return [check_output_ssh(host, self.opts, "bash -s", input_data=prologue + "\n" + cmd)
+                for cmd in cmds]
+
+    def emit_ssh_result(self, host, path, format, cmd, ok, out):
         if not ok:
-	    if "command not found" in out:
+            if isinstance(out, Unavailable):
+                logger.debug("Cmd {0} skipped on node {1}: {2}".format(cmd, host, out))
+            elif "command not found" in out:
                 logger.warning("Cmd {0} not found on node {1}".format(cmd, host))
-	    else:
+            else:
                 logger.warning("Cmd {0} failed on node {1}".format(cmd, host))
         self.emit(path, format, ok, out, check=False)
 
@@ -131,6 +1550,10 @@ class Collector(object):
         if check:
             if not self.collect_settings.allowed(path):
                 return
+
+        if not ok and isinstance(out, Unavailable):
+            self.res_q.put((True, path, 'unavailable', out))
+            return
         self.res_q.put((ok, path, (format if ok else 'err'), out))
 
     # should provides set of on_XXX methods
@@ -140,7 +1563,10 @@ class Collector(object):
 
     # util functions, used in different classes
     def get_host_interfaces(self, host):
-        ok, net_devs = check_output_ssh(host, self.opts, 'ls -l /sys/class/net')
+        return self.parse_host_interfaces(host, *check_output_ssh(host, self.opts, 'ls -l /sys/class/net'))
+
+    def parse_host_interfaces(self, host, ok, net_devs):
+        "yields (is physical, device) from 'ls -l /sys/class/net' result"
         if not ok:
             logger.warning("'ls -l /sys/class/net' failed %s", net_devs)
             return
@@ -159,6 +1585,124 @@ class Collector(object):
             yield ('devices/pci' in params[10]), params[8]
 
 
+# log_since FILE INODE OFFSET MTIME HEAD MAX_LINES MAX_BYTES FILTER
+# prints 'inode size mtime head mode' line and log data, which was added after OFFSET
+# of file with INODE, MTIME and checksum of first bytes HEAD (see log_head), or last
+# MAX_LINES lines if INODE is '-'. New inode means, that log was rotated: the rest of
+# old log is taken from FILE.1 with INODE or from FILE.1.gz, if FILE.1 is already gone
+# and FILE.1.gz was modified not before MTIME, has at least OFFSET bytes and the same
+# HEAD. Log with the same inode, but other HEAD or smaller size was truncated in place.
+# Only last MAX_BYTES of data, matching FILTER regexp, are sent. Data, appended after
+# stat, and incomplete last line are left for the next run, line, cut by OFFSET, is skipped.
+# mode - 'append' (data after OFFSET), 'rotated' (rest of old log and new log),
+# 'gap' (log was truncated or rest of rotated log isn't found, new log only) or 'last'
+log_since_prologue = """
+log_part() {
+    if [ $2 -eq 0 ] ; then
+        head -c $3 "$1"
+    else
+        tail -c +$2 "$1" | head -c $(( $3 - $2 + 1 )) | sed '1d'
+    fi
+}
+log_head() {
+    head -c $(( $1 < 256 ? $1 : 256 )) | cksum | cut -d' ' -f1
+}
+log_since() {
+    local ino
+    ino=$(stat -c %i "$1") || return 1
+    local size=$(stat -c %s "$1") mtime=$(stat -c %Y "$1")
+    local chunk=$(( size < 4096 ? size : 4096 ))
+    local part=$( { tail -c +$(( size - chunk + 1 )) "$1" | head -c $chunk ; echo ; } | LC_ALL=C awk 'END {print length($0)}')
+    [ "$part" -lt $chunk ] && size=$(( size - part ))
+    local mode=last old=
+    if [ "$2" = "$ino" ] && [ $3 -le $size ] && { [ "$5" = "-" ] || [ "$(log_head $3 <"$1")" = "$5" ] ; } ; then
+        mode=append
+    elif [ "$2" != "-" ] ; then
+        mode=gap
+        if [ "$2" = "$ino" ] ; then
+            :
+        elif [ "$(stat -c %i "$1.1" 2>/dev/null)" = "$2" ] ; then
+            mode=rotated old="$1.1"
+        elif [ ! -e "$1.1" ] && [ -f "$1.1.gz" ] && [ $4 -gt 0 ] && \\
+                [ "$(stat -c %Y "$1.1.gz")" -ge $4 ] && \\
+                [ "$(zcat "$1.1.gz" 2>/dev/null | head -c $3 | wc -c)" -eq $3 ] && \\
+                [ "$(zcat "$1.1.gz" 2>/dev/null | log_head $3)" = "$5" ] ; then
+            mode=rotated old="$1.1.gz"
+        fi
+    fi
+    echo $ino $size $mtime $(log_head $size <"$1") $mode
+    {
+        if [ $mode = append ] ; then
+            log_part "$1" $3 $size
+        elif [ $mode = last ] ; then
+            head -c $size "$1" | tail -n $6
+        else
+            if [ "$old" = "$1.1" ] ; then
+                log_part "$1.1" $3 $(stat -c %s "$1.1")
+            elif [ -n "$old" ] && [ $3 -eq 0 ] ; then
+                zcat "$old"
+            elif [ -n "$old" ] ; then
+                zcat "$old" | tail -c +$3 | sed '1d'
+            fi 2>/dev/null
+            head -c $size "$1"
+        fi
+    } | if [ -n "$8" ] ; then { grep -E -e "$8" || true ; } else cat ; fi | tail -c $7
+}
+"""
+
+# regexp of ceph cluster log lines with given or higher severity
+LOG_SEVERITY_PATTERNS = {
+    'WRN': r'\[(WRN|ERR|SEC)\]',
+    'ERR': r'\[(ERR|SEC)\]',
+}
+
+
+class LogOffsets(object):
+    """Inode, size, mtime and head checksum of remote log files at the end of previous collection
+
+    Kept in file between runs, so every run fetches only log lines,
+    which were added since the previous one.
+    """
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.offsets = {}
+
+        if fname is not None and os.path.exists(fname):
+            try:
+                self.offsets = json.load(open(fname))
+            except (IOError, ValueError) as exc:
+                logger.warning("Can't load log offsets from %r: %s", fname, exc)
+
+    def get(self, host, log_file):
+        "returns (inode, offset, mtime, head), ('-', 0, 0, '-') for not known logs"
+        with self.lock:
+            state = self.offsets.get(host, {}).get(log_file)
+        if state is None:
+            return '-', 0, 0, '-'
+        return state['inode'], state['offset'], state.get('mtime', 0), state.get('head', '-')
+
+    def update(self, host, log_file, inode, offset, mtime, head):
+        with self.lock:
+            self.offsets.setdefault(host, {})[log_file] = {'inode': inode, 'offset': offset,
+                                                           'mtime': mtime, 'head': head}
+
+    def save(self):
+        if self.fname is None:
+            return
+
+        try:
+            with self.lock:
+                data = json.dumps(self.offsets, indent=4, sort_keys=True)
+            open(self.fname, "w").write(data)
+        except IOError as exc:
+            logger.warning("Can't save log offsets to %r: %s", self.fname, exc)
+
+
+# This variable is updated from main function
+LOG_OFFSETS = None
+
+
 class CephDataCollector(Collector):
 
     name = 'ceph'
@@ -166,13 +1710,28 @@ class CephDataCollector(Collector):
 
     def __init__(self, *args, **kwargs):
         Collector.__init__(self, *args, **kwargs)
-        self.ceph_cmd = "ceph -c {0.conf} -k {0.key} --format json ".format(self.opts)
 
         self.osd_devs = {}
         self.osd_devs_lock = threading.Lock()
 
-    def collect_master(self, path=None, node=None):
+    def master_query(self, name, cmd):
+        t1 = time.time()
+        ok, out = ceph_query(self.opts, cmd)
+        backend = CEPH_BACKEND.name if CEPH_BACKEND is not None else CephCLIBackend.name
+        TRACER.add(cmd, 'ceph', t1, time.time(), backend=backend, ok=ok, bytes=len(out))
+        logger.info("Master query %r %s in %.2fs", name, "done" if ok else "failed", time.time() - t1)
+        if not ok:
+            logger.warning("Ceph query {0!r} failed: {1}".format(cmd, out.strip()))
+        return ok, out
+
+    def collect_master(self, path=None, node=None, discovered=None):
+        """collect cluster-wide data with local ceph commands
+
+        discovered - {ceph cmd: (ok, out)}, results from discovery stage,
+        which are reused instead of running same commands again
+        """
         path = path + "/master/"
+        discovered = discovered if discovered is not None else {}
 
         curr_data = "{0}\n{1}\n{2}".format(
             datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -181,7 +1740,7 @@ class CephDataCollector(Collector):
 
         self.emit(path + "collected_at", 'txt', True, curr_data)
 
-        ok, status = check_output(self.ceph_cmd + "status")
+        ok, status = self.master_query("status", "status")
         self.emit(path + "status", 'json', ok, status)
         assert ok
 
@@ -198,125 +1757,237 @@ class CephDataCollector(Collector):
         else:
             cmds.append('pg dump')
 
-        for cmd in cmds:
-            self.run2emit(path + cmd.replace(" ", "_"), 'json',
-                          self.ceph_cmd + cmd)
-
-        self.run2emit(path + "rados_df", 'json',
-                      "rados df -c {0.conf} -k {0.key} --format json".format(self.opts))
-
-        ok, out = check_output(self.ceph_cmd + 'health detail')
-        if not ok:
-            self.emit(path + 'health_detail', 'err', ok, out)
-        else:
-            self.emit(path + 'health_detail', 'json', ok, out)
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            out_file = os.tempnam()
-
-        ok, out = check_output(self.ceph_cmd + "osd getcrushmap -o " + out_file)
-        if not ok:
-            self.emit(path + 'crushmap', 'err', ok, out)
-        else:
-            data = open(out_file, "rb").read()
-            os.unlink(out_file)
-            self.emit(path + 'crushmap', 'bin', ok, data)
-
-    def emit_device_info(self, host, path, device_file):
-        ok, dev_str = check_output_ssh(host, self.opts, "df " + device_file)
-        assert ok
-        dev_data = dev_str.strip().split("\n")[1].split()
-
-        used = int(dev_data[2]) * 1024
-        avail = int(dev_data[3]) * 1024
-
-        root_dev, dev = get_device_for_file(host, self.opts, device_file)
-
-        cmd = "cat /sys/block/{0}/queue/rotational".format(os.path.basename(root_dev))
-        ok, is_ssd_str = check_output_ssh(host, self.opts, cmd)
-        assert ok
-        is_ssd = is_ssd_str.strip() == '0'
-
-        self.ssh2emit(host, path + '/hdparm', 'txt', "sudo hdparm -I " + root_dev)
-        self.ssh2emit(host, path + '/smartctl', 'txt', "sudo smartctl -a " + root_dev)
-        self.emit(path + '/stats', 'json', True,
-                  json.dumps({'dev': dev,
-                              'root_dev': root_dev,
-                              'used': used,
-                              'avail': avail,
-                              'is_ssd': is_ssd}))
-        return root_dev
-
-    def collect_osd(self, path, host, osd_id):
-        path = "{0}/osd/{1}/".format(path, osd_id)
-        ok, out = check_output_ssh(host, self.opts, "ps aux | grep ceph-osd")
-
-        for line in out.split("/n"):
-            if '--id ' + str(osd_id) in line and 'ceph-osd' in line:
-                osd_running = True
-                break
-            if '-i ' + str(osd_id) in line and 'ceph-osd' in line:
-                osd_running = True
-                break
-        else:
-            osd_running = False
-            logger.warning("osd-{0} in node {1} is down.".format(osd_id, host) +
-                           " No config available, will use default data and journal path")
-
-        self.emit(path + "osd_daemons", 'txt', ok, out)
-        self.ssh2emit(host, path + "log", 'txt',
-                      "tail -n {0} /var/log/ceph/ceph-osd.{1}.log".format(
-                          self.opts.ceph_log_max_lines, osd_id))
+        # (name, format, cmd)
+        queries = [(cmd.replace(" ", "_"), 'json', cmd) for cmd in cmds]
+        queries.append(("rados_df", 'json', "rados df"))
+        queries.append(("health_detail", 'json', 'health detail'))
+        queries.append(("crushmap", 'bin', "osd getcrushmap"))
 
-        if osd_running:
-            osd_cfg_cmd = "sudo ceph -f json --admin-daemon /var/run/ceph/ceph-osd.{0}.asok config show"
-            ok, data = check_output_ssh(host, self.opts, osd_cfg_cmd.format(osd_id))
+        queries = [(name, frmt, cmd) for name, frmt, cmd in queries
+                   if self.collect_settings.allowed(path + name)]
 
-            self.emit(path + "config", 'json', ok, data)
-            assert ok
-
-            osd_cfg = json.loads(data)
-
-            data_dev = osd_cfg.get('osd_data')
-            jdev = osd_cfg.get('osd_journal')
+        results = {}
+        for cmd in cmds:
+            if cmd in discovered and discovered[cmd][0]:
+                logger.info("Master query %r reused from discovery", cmd.replace(" ", "_"))
+                results[cmd.replace(" ", "_")] = discovered[cmd]
+
+        runs = [(self.master_query, [name, cmd], {})
+                for name, _, cmd in queries if name not in results]
+
+        t1 = time.time()
+        limiter = make_limiter(self.opts, "Master queries", self.opts.master_concurrency)
+        for (_, (name, _), _), (call_ok, res) in zip(runs, prun(runs, self.opts.master_concurrency, limiter)):
+            results[name] = res if call_ok else (False, str(res))
+        logger.info("%s master queries done in %.2fs with concurrency %s",
+                    len(runs), time.time() - t1, self.opts.master_concurrency)
+
+        for name, frmt, _ in queries:
+            ok, out = results[name]
+            self.emit(path + name, frmt, ok, out)
+
+    osd_log_file = "/var/log/ceph/ceph-osd.{0}.log"
+    osd_cfg_cmd = "sudo ceph -f json --admin-daemon /var/run/ceph/ceph-osd.{0}.asok config show"
+    disk_info_cmds = [('hdparm', "sudo hdparm -I {0}"),
+                      ('smartctl', "sudo smartctl -a {0}")]
+
+    def log_cmd(self, host, log_file):
+        "command to get new lines of log_file, must be run with log_since_prologue"
+        inode, offset, mtime, head = ('-', 0, 0, '-') if LOG_OFFSETS is None else LOG_OFFSETS.get(host, log_file)
+
+        patterns = list(self.opts.log_filter)
+        if self.opts.log_severity is not None:
+            patterns.append(LOG_SEVERITY_PATTERNS[self.opts.log_severity])
+
+        return "log_since {0} {1} {2} {3} {4} {5} {6} {7}".format(
+            log_file, inode, offset, mtime, head, self.opts.ceph_log_max_lines, self.opts.ceph_log_max_bytes,
+            pipes.quote("|".join("({0})".format(pattern) for pattern in patterns)))
+
+    def emit_log(self, host, log_path, log_file, cmd, ok, out):
+        """emit log_since output without header and remember new log offset
+
+        With log offsets log holds only lines, added since the previous run,
+        so range of log data is stored in log_path + '_offset'
+        """
+        if ok:
+            header, _, out = out.partition("\n")
+            try:
+                inode, size, mtime, head, mode = header.split()
+                inode, size, mtime = int(inode), int(size), int(mtime)
+            except ValueError:
+                ok, out = False, "Broken log_since output header {0!r}".format(header)
+
+        if ok and mode == 'gap':
+            logger.warning("Log %s on node %s was truncated or its rotated part isn't found, " +
+                           "lines since previous run may be lost", log_file, host)
+
+        if ok and LOG_OFFSETS is not None:
+            prev_inode, prev_offset, prev_mtime, _ = LOG_OFFSETS.get(host, log_file)
+            LOG_OFFSETS.update(host, log_file, inode, size, mtime, head)
+            offset = {'file': log_file, 'mode': mode, 'inode': inode, 'size': size, 'mtime': mtime,
+                      'prev_inode': prev_inode, 'prev_offset': prev_offset, 'prev_mtime': prev_mtime}
+            self.emit(log_path + "_offset", 'json', True, json.dumps(offset))
+
+        self.emit_ssh_result(host, log_path, 'txt', cmd, ok, out)
+
+    def emit_device_info(self, host, path, df_res, dev_info, disk_info):
+        "disk_info - {(root_dev, tool): (ok, out)}, returns root device"
+        ok, out = df_res
+        if not ok or dev_info is None:
+            if ok:
+                out = "Can't find block device in device index"
+            logger.warning("Can't get device for %s on node %s: %s", path, host, out.strip())
+            self.emit(path + '/stats', 'err', False, out)
+            return None
 
-            if data_dev is not None:
-                data_dev = str(data_dev)
+        dev_data = out.strip().split("\n")[1].split()
+        stats = dev_info.copy()
+        stats['used'] = int(dev_data[2]) * 1024
+        stats['avail'] = int(dev_data[3]) * 1024
 
-            if jdev is not None:
-                jdev = str(jdev)
+        for tool, cmd in self.disk_info_cmds:
+            if not self.collect_settings.allowed(path + '/' + tool):
+                continue
+            ok, out = disk_info[(dev_info['root_dev'], tool)]
+            self.emit_ssh_result(host, path + '/' + tool, 'txt',
+                                 cmd.format(dev_info['root_dev']), ok, out)
+
+        self.emit(path + '/stats', 'json', True, json.dumps(stats))
+        return dev_info['root_dev']
+
+    def emit_daemons(self, path, host, osd_ids, snapshot):
+        self.emit("{0}/hosts/{1}/ceph_daemons".format(path, host), 'json', snapshot.ok,
+                  json.dumps(snapshot.daemons()) if snapshot.ok else snapshot.error)
+
+        for osd_id in osd_ids:
+            self.emit("{0}/osd/{1}/osd_daemons".format(path, osd_id), 'txt', snapshot.ok,
+                      snapshot.daemons_text('osd') if snapshot.ok else snapshot.error)
+
+    def collect_osd(self, path, host, osd_ids):
+        """collect data for all osd's on host
+
+        All commands are executed in three ssh sessions: first gets daemons,
+        logs, configs and device index, second - storage listing, df and real
+        path for data and journal from configs, third - hdparm and smartctl,
+        once per physical device
+        """
+        snapshot = PROCESS_SNAPSHOTS.get(host, self.opts)
+        self.emit_daemons(path, host, osd_ids, snapshot)
+
+        # {osd_id: log cmd} for osd's with not disabled log
+        log_cmds = {}
+        cmds = [HostDeviceIndex.scan_cmd]
+        for osd_id in osd_ids:
+            if self.collect_settings.allowed("{0}/osd/{1}/log".format(path, osd_id)):
+                log_cmds[osd_id] = self.log_cmd(host, self.osd_log_file.format(osd_id))
+                cmds.append(log_cmds[osd_id])
+            cmds.append(self.osd_cfg_cmd.format(osd_id))
+
+        results = iter(self.run_ssh_batch(host, cmds, log_since_prologue))
+        scan_ok, scan_out = next(results)
+        if not scan_ok:
+            logger.warning("Can't scan block devices on node %s: %s", host, scan_out.strip())
+        dev_index = HostDeviceIndex(scan_out if scan_ok else "")
+        osd_paths = {}
+
+        for osd_id in osd_ids:
+            opath = "{0}/osd/{1}/".format(path, osd_id)
+            if osd_id in log_cmds:
+                self.emit_log(host, opath + "log", self.osd_log_file.format(osd_id),
+                              log_cmds[osd_id], *next(results))
+            cfg_ok, cfg = next(results)
+
+            osd_running = snapshot.osd_running(osd_id)
+            if not osd_running:
+                logger.warning("osd-{0} in node {1} is down.".format(osd_id, host) +
+                               " No config available, will use default data and journal path")
 
-        else:
             data_dev = None
             jdev = None
 
-        if data_dev is None:
-            data_dev = "/var/lib/ceph/osd/ceph-{0}".format(osd_id)
-
-        if jdev is None:
-            jdev = "/var/lib/ceph/osd/ceph-{0}/journal".format(osd_id)
-
-        self.ssh2emit(host, path + "storage_ls", 'txt',
-                      "ls -1 " + os.path.join(data_dev, 'current'))
-        data_root_dev = self.emit_device_info(host, path + "data", data_dev)
-        jroot_dev = self.emit_device_info(host, path + "journal", jdev)
-
-        with self.osd_devs_lock:
-            self.osd_devs[osd_id] = (host, data_root_dev, jroot_dev)
+            if osd_running:
+                self.emit(opath + "config", 'json', cfg_ok, cfg)
+                if cfg_ok:
+                    osd_cfg = json.loads(cfg)
+                    data_dev = osd_cfg.get('osd_data')
+                    jdev = osd_cfg.get('osd_journal')
+                else:
+                    logger.warning("Can't get osd-%s config on node %s", osd_id, host)
+
+            if data_dev is None:
+                data_dev = "/var/lib/ceph/osd/ceph-{0}".format(osd_id)
+
+            if jdev is None:
+                jdev = "/var/lib/ceph/osd/ceph-{0}/journal".format(osd_id)
+
+            osd_paths[osd_id] = (opath, str(data_dev), str(jdev))
+
+        cmds = []
+        for osd_id in osd_ids:
+            opath, data_dev, jdev = osd_paths[osd_id]
+            if self.collect_settings.allowed(opath + "storage_ls"):
+                cmds.append("ls -1 " + os.path.join(data_dev, 'current'))
+            for dev_path in (data_dev, jdev):
+                cmds.append('df -P -k "{0}"'.format(dev_path))
+                cmds.append('readlink -f "{0}"'.format(dev_path))
+
+        results = iter(self.run_ssh_batch(host, cmds))
+        osd_devs_info = {}
+
+        for osd_id in osd_ids:
+            opath, data_dev, jdev = osd_paths[osd_id]
+            if self.collect_settings.allowed(opath + "storage_ls"):
+                self.emit_ssh_result(host, opath + "storage_ls", 'txt',
+                                     "ls -1 " + os.path.join(data_dev, 'current'), *next(results))
+
+            devs_info = []
+            for dev_path in (data_dev, jdev):
+                df_res = next(results)
+                real_path_ok, real_path = next(results)
+                dev_info = dev_index.resolve(real_path.strip()) if real_path_ok else None
+                devs_info.append((df_res, dev_info))
+            osd_devs_info[osd_id] = devs_info
+
+        # (root device, tool) for not disabled results of any osd
+        disk_info_keys = set()
+        for osd_id, devs_info in osd_devs_info.items():
+            for name, (_, dev_info) in zip(('data', 'journal'), devs_info):
+                if dev_info is None:
+                    continue
+                for tool, _ in self.disk_info_cmds:
+                    if self.collect_settings.allowed(osd_paths[osd_id][0] + name + '/' + tool):
+                        disk_info_keys.add((dev_info['root_dev'], tool))
+
+        disk_info_keys = sorted(disk_info_keys)
+        tool_cmds = dict(self.disk_info_cmds)
+        cmds = [tool_cmds[tool].format(root_dev) for root_dev, tool in disk_info_keys]
+
+        disk_info = dict(zip(disk_info_keys, self.run_ssh_batch(host, cmds)))
+
+        for osd_id in osd_ids:
+            opath = osd_paths[osd_id][0]
+            osd_root_devs = [self.emit_device_info(host, opath + name, dev_df_res, dev_data, disk_info)
+                             for name, (dev_df_res, dev_data) in zip(('data', 'journal'), osd_devs_info[osd_id])]
+
+            if None not in osd_root_devs:
+                with self.osd_devs_lock:
+                    self.osd_devs[osd_id] = (host, osd_root_devs[0], osd_root_devs[1])
 
     def collect_monitor(self, path, host, name):
         path = "{0}/mon/{1}/".format(path, host)
-        self.ssh2emit(host, path + "mon_daemons", 'txt', "ps aux | grep ceph-mon")
-        self.ssh2emit(host, path + "mon_log", 'txt',
-                      "tail -n {0} /var/log/ceph/ceph-mon.{1}.log".format(
-                          self.opts.ceph_log_max_lines, name))
-        self.ssh2emit(host, path + "ceph_log", 'txt',
-                      "tail -n {0} /var/log/ceph/ceph.log".format(
-                          self.opts.ceph_log_max_lines, name))
-        self.ssh2emit(host, path + "ceph_audit", 'txt',
-                      "tail -n {0} /var/log/ceph/ceph.audit.log".format(
-                          self.opts.ceph_log_max_lines, name))
+        snapshot = PROCESS_SNAPSHOTS.get(host, self.opts)
+        self.emit(path + "mon_daemons", 'txt', snapshot.ok,
+                  snapshot.daemons_text('mon') if snapshot.ok else snapshot.error)
+        logs = [(path + "mon_log", "/var/log/ceph/ceph-mon.{0}.log".format(name)),
+                (path + "ceph_log", "/var/log/ceph/ceph.log"),
+                (path + "ceph_audit", "/var/log/ceph/ceph.audit.log")]
+        logs = [(log_path, log_file) for log_path, log_file in logs
+                if self.collect_settings.allowed(log_path)]
+
+        cmds = [self.log_cmd(host, log_file) for _, log_file in logs]
+        results = self.run_ssh_batch(host, cmds, log_since_prologue)
+        for (log_path, log_file), cmd, res in zip(logs, cmds, results):
+            self.emit_log(host, log_path, log_file, cmd, *res)
 
 
 class NodeCollector(Collector):
@@ -342,59 +2013,111 @@ class NodeCollector(Collector):
         ("netstat", "txt", "netstat -nap")
     ]
 
+    # results, which rarely change: seconds to reuse them from base archive
+    # of incremental run without any check. Older ones are revalidated by md5
+    static_results = {
+        "lshw": 7 * 24 * 3600,
+        "dmidecode": 7 * 24 * 3600,
+        "cpuinfo": 24 * 3600,
+        "uname": 24 * 3600,
+        "ceph_conf": 3600,
+        "interfaces": 6 * 3600,
+    }
+
+    @classmethod
+    def static_ttl(cls, fname):
+        "ttl of archived result, 0 for results, which must be collected every run"
+        parts = fname.split('/')
+        if len(parts) == 3 and parts[0] == 'hosts':
+            return cls.static_results.get(parts[2].rsplit('.', 1)[0], 0)
+        return 0
+
     def collect_node(self, path, host):
         path = 'hosts/' + host + '/'
+        items = []
+        known_md5 = {}
         for path_off, frmt, cmd in self.node_commands:
-            self.ssh2emit(host, path + path_off, frmt, cmd)
-        self.collect_interfaces_info(path, host)
+            fname = path + path_off + '.' + frmt
+            if INCREMENTAL_BASE is not None and INCREMENTAL_BASE.fresh(fname):
+                self.emit(path + path_off, frmt, True, INCREMENTAL_BASE.unchanged(fname))
+                continue
 
-    def collect_interfaces_info(self, path, host):
-        interfaces = {}
-        for is_phy, dev in self.get_host_interfaces(host):
-            interface = {'dev': dev, 'is_phy': is_phy}
-            interfaces[dev] = interface
+            if INCREMENTAL_BASE is not None and path_off in self.static_results:
+                known_md5[path + path_off] = INCREMENTAL_BASE.md5(fname)
+            items.append((path + path_off, frmt, cmd))
 
-            if not is_phy:
-                continue
+        completion = Completion()
 
+        def commands_done():
+            if INCREMENTAL_BASE is not None and INCREMENTAL_BASE.fresh(path + 'interfaces.json'):
+                self.emit(path + 'interfaces', 'json', True,
+                          INCREMENTAL_BASE.unchanged(path + 'interfaces.json'))
+                completion.done()
+            else:
+                self.collect_interfaces_info(path, host, completion.guard(completion.done))
+
+        self.ssh2emit_batch_async(host, items, completion.guard(commands_done), known_md5=known_md5)
+        return completion
+
+    def collect_interfaces_info(self, path, host, callback):
+        "emits interfaces info and calls callback()"
+        def devs_listed(ok, net_devs):
+            devs = list(self.parse_host_interfaces(host, ok, net_devs))
+            phy_devs = [dev for is_phy, dev in devs if is_phy]
+            cmds = [cmd + dev for dev in phy_devs for cmd in ("ethtool ", "iwconfig ")]
+            check_output_ssh_batch_async(host, self.opts, cmds, lambda results: speeds_got(devs, results))
+
+        def speeds_got(devs, results):
+            results = iter(results)
+            interfaces = {}
+            for is_phy, dev in devs:
+                interface = {'dev': dev, 'is_phy': is_phy}
+                interfaces[dev] = interface
+                if is_phy:
+                    self.fill_interface_speed(host, interface, next(results), next(results))
+
+            self.emit(path + 'interfaces', 'json', True, json.dumps(interfaces))
+            callback()
+
+        check_output_ssh_async(host, self.opts, 'ls -l /sys/class/net', devs_listed)
+
+    def fill_interface_speed(self, host, interface, ethtool_res, iwconfig_res):
+        speed = None
+        ok, data = ethtool_res
+        if ok:
+            for line in data.split("\n"):
+                if 'Speed:' in line:
+                    speed = line.split(":")[1].strip()
+                if 'Duplex:' in line:
+                    interface['duplex'] = line.split(":")[1].strip() == 'Full'
+
+        ok, data = iwconfig_res
+        if ok and 'Bit Rate=' in data:
+            br1 = data.split('Bit Rate=')[1]
+            if 'Tx-Power=' in br1:
+                speed = br1.split('Tx-Power=')[0]
+
+        if speed == "Unknown!":
             speed = None
-            ok, data = check_output_ssh(host, self.opts, "ethtool " + dev)
-            if ok:
-                for line in data.split("\n"):
-                    if 'Speed:' in line:
-                        speed = line.split(":")[1].strip()
-                    if 'Duplex:' in line:
-                        interface['duplex'] = line.split(":")[1].strip() == 'Full'
-
-            ok, data = check_output_ssh(host, self.opts, "iwconfig " + dev)
-            if ok and 'Bit Rate=' in data:
-                br1 = data.split('Bit Rate=')[1]
-                if 'Tx-Power=' in br1:
-                    speed = br1.split('Tx-Power=')[0]
-
-            if speed == "Unknown!":
-                speed = None
-
-            if speed is not None:
-                mults = {
-                    'Kb/s': 125,
-                    'Mb/s': 125000,
-                    'Gb/s': 125000000,
-                }
-                for name, mult in mults.items():
-                    if name in speed:
-                        speed = int(speed.replace(name, '')) * mult
-                        break
-                else:
-                    logger.warning("Node %s - can't transform %s interface speed %r to Bps",
-                                   host, dev, speed)
 
-                if isinstance(speed, int):
-                    interface['speed'] = speed
-                else:
-                    interface['speed_s'] = speed
+        if speed is not None:
+            mults = {
+                'Kb/s': 125,
+                'Mb/s': 125000,
+                'Gb/s': 125000000,
+            }
+            for name, mult in mults.items():
+                if name in speed:
+                    speed = int(speed.replace(name, '')) * mult
+                    break
+            else:
+                logger.warning("Node %s - can't transform %s interface speed %r to Bps",
+                               host, interface['dev'], speed)
 
-        self.emit(path + 'interfaces', 'json', True, json.dumps(interfaces))
+            if isinstance(speed, int):
+                interface['speed'] = speed
+            else:
+                interface['speed_s'] = speed
 
 
 class NodeResourseUsageCollector(Collector):
@@ -402,11 +2125,12 @@ class NodeResourseUsageCollector(Collector):
     run_alone = True
 
     def collect_node(self, path, host):
-        cpath = '{0}/rusage/{1}/{2}-disk'.format(path, host, int(time.time()))
-        self.ssh2emit(host, cpath, "txt", "cat /proc/diskstats")
-
-        cpath = '{0}/rusage/{1}/{2}-net'.format(path, host, int(time.time()))
-        self.ssh2emit(host, cpath, "txt", "cat /proc/net/dev")
+        ctime = int(time.time())
+        items = [('{0}/rusage/{1}/{2}-disk'.format(path, host, ctime), "txt", "cat /proc/diskstats"),
+                 ('{0}/rusage/{1}/{2}-net'.format(path, host, ctime), "txt", "cat /proc/net/dev")]
+        completion = Completion()
+        self.ssh2emit_batch_async(host, items, completion.guard(completion.done))
+        return completion
 
 
 performance_monitor_code_templ = """#!/bin/bash
@@ -460,13 +2184,9 @@ class CephPerformanceCollector(Collector):
         uniq_devs = " ".join(set(osd_devs))
         grep_re = "|".join(map("\\b{0}\\b".format, set(osd_devs)))
 
-        ok, osd_pids = check_output_ssh(host, self.opts, "ps aux")
-        assert ok
-        osd_pid_list = []
-        for process in osd_pids.strip().split("\n"):
-            vals = process.split()
-            if 'ceph-osd' in vals[10]:
-                osd_pid_list.append(vals[1])
+        snapshot = PROCESS_SNAPSHOTS.get(host, self.opts)
+        assert snapshot.ok, snapshot.error
+        osd_pid_list = [str(proc['pid']) for proc in snapshot.daemons('osd')]
 
         all_devs = []
         phy_devs = []
@@ -478,140 +2198,1684 @@ class CephPerformanceCollector(Collector):
 
         all_devs_re = "|".join(map("\\b{0}\\b".format, all_devs))
 
-        performance_monitor_code = performance_monitor_code_templ \
-            .replace('__runtime__', str(self.opts.performance_collect_seconds)) \
-            .replace('__io_file__', self.io_file) \
-            .replace('__net_file__', self.net_file) \
-            .replace('__cpu_file__', self.cpu_file) \
-            .replace('__uniq_osd_devs__', uniq_devs) \
-            .replace('__devs_grep_pattern__', grep_re) \
-            .replace('__osd_pids__', ",".join(osd_pid_list)) \
-            .replace('__net_grep_pattern__', all_devs_re)
+        performance_monitor_code = performance_monitor_code_templ \
+            .replace('__runtime__', str(self.opts.performance_collect_seconds)) \
+            .replace('__io_file__', self.io_file) \
+            .replace('__net_file__', self.net_file) \
+            .replace('__cpu_file__', self.cpu_file) \
+            .replace('__uniq_osd_devs__', uniq_devs) \
+            .replace('__devs_grep_pattern__', grep_re) \
+            .replace('__osd_pids__', ",".join(osd_pid_list)) \
+            .replace('__net_grep_pattern__', all_devs_re)
+
+        open(local_file, "w").write(performance_monitor_code)
+        try:
+            scp_cmd = "scp {0} {1} {2}:{3}".format(ssh_host_opts(host), local_file,
+                                                   host, self.remote_file)
+
+            ok, _ = check_output(scp_cmd)
+            assert ok
+        finally:
+            os.unlink(local_file)
+
+        start_cmd = 'screen -S ceph_monitor -d -m bash ' + self.remote_file
+        check_output_ssh(host, self.opts, start_cmd, no_retry=True)
+
+    def collect_performance_data(self, path, host):
+        all_files = {'io': self.io_file,
+                     'cpu': self.cpu_file,
+                     'net': self.net_file}
+
+        for tp, fname in all_files.items():
+            self.ssh2emit(host,
+                          "{0}/perf_monitoring/{1}/{2}".format(path, host, tp),
+                          "txt", 'cat ' + fname)
+        check_output_ssh(host, self.opts, "rm -f " +
+                         " ".join(all_files.values() + [self.remote_file]),
+                         no_retry=True)
+
+
+remote_agent_code_templ = r"""
+import os
+import re
+import sys
+import json
+import stat
+import zlib
+import subprocess
+
+params = json.loads(__params__)
+os.environ['PATH'] = os.environ.get('PATH', '') + os.pathsep + params['tools_path']
+disabled = set(params['disabled'])
+records = []
+meta = {'interfaces': {}, 'osd_devs': {}, 'errors': []}
+
+
+def to_str(data):
+    if isinstance(data, bytes):
+        return data.decode('utf8', 'replace')
+    return data
+
+
+def emit(path, frmt, ok, data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf8')
+    records.append((path, frmt, ok, data))
+
+
+def has_timeout_tool():
+    return any(os.access(os.path.join(dname, 'timeout'), os.X_OK)
+               for dname in os.environ.get('PATH', '').split(os.pathsep))
+
+
+# coreutils timeout kills whole process group of command
+timeout_cmd = None
+if params.get('cmd_timeout') is not None and has_timeout_tool():
+    timeout_cmd = ['timeout', '-k', '5', str(params['cmd_timeout']), 'sh', '-c']
+
+
+def run(cmd):
+    with open(os.devnull) as devnull:
+        proc = subprocess.Popen(cmd if timeout_cmd is None else timeout_cmd + [cmd],
+                                shell=timeout_cmd is None, stdin=devnull,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    if proc.returncode == 0:
+        return True, out
+    if timeout_cmd is not None and proc.returncode in (124, 137):
+        err += "\nKilled by timeout after {0}s\n".format(params['cmd_timeout']).encode('utf8')
+    return False, out + err
+
+
+def read(fname):
+    try:
+        with open(fname, 'rb') as fd:
+            return True, fd.read()
+    except (IOError, OSError) as exc:
+        return False, str(exc)
+
+
+def run_or_read(cmd):
+    # 'cat FILE' commands are served directly from /proc, /sys and /etc
+    parts = cmd.split()
+    if len(parts) == 2 and parts[0] == 'cat':
+        return read(parts[1])
+    return run(cmd)
+
+
+def collect_node():
+    for path, frmt, cmd in params['node_commands']:
+        ok, out = run_or_read(cmd)
+        emit(path, frmt, ok, out)
+
+    unavailable = params['unavailable_tools']
+
+    for dev in os.listdir('/sys/class/net'):
+        dev_path = os.path.join('/sys/class/net', dev)
+        if not os.path.islink(dev_path):
+            continue
+
+        is_phy = 'devices/pci' in os.readlink(dev_path)
+        info = {'is_phy': is_phy}
+        if is_phy:
+            for tool in ('ethtool', 'iwconfig'):
+                if tool in unavailable:
+                    info[tool] = [False, unavailable[tool]]
+                else:
+                    ok, out = run(tool + " " + dev)
+                    info[tool] = [ok, to_str(out)]
+        meta['interfaces'][dev] = info
+
+
+def block_dev(fname):
+    "return (partition or disk, whole disk) for file or block device"
+    st = os.stat(fname)
+    dev_num = st.st_rdev if stat.S_ISBLK(st.st_mode) else st.st_dev
+    sys_path = os.path.realpath("/sys/dev/block/{0}:{1}".format(os.major(dev_num), os.minor(dev_num)))
+    dev = os.path.basename(sys_path)
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        root_dev = os.path.basename(os.path.dirname(sys_path))
+    else:
+        root_dev = dev
+    return '/dev/' + dev, '/dev/' + root_dev
+
+
+# {(root_dev, tool): (ok, out)}
+disk_info_cache = {}
+disk_info_cmds = [('hdparm', "sudo hdparm -I "), ('smartctl', "sudo smartctl -a ")]
+
+
+def emit_device_info(path, fname):
+    fs_stat = os.statvfs(fname)
+    dev, root_dev = block_dev(fname)
+    ok, rotational = read("/sys/block/{0}/queue/rotational".format(os.path.basename(root_dev)))
+
+    for tool, cmd in disk_info_cmds:
+        if path + '/' + tool in disabled:
+            continue
+        if (root_dev, tool) not in disk_info_cache:
+            disk_info_cache[(root_dev, tool)] = run(cmd + root_dev)
+        tool_ok, out = disk_info_cache[(root_dev, tool)]
+        emit(path + '/' + tool, 'txt', tool_ok, out)
+
+    emit(path + '/stats', 'json', True,
+         json.dumps({'dev': dev,
+                     'root_dev': root_dev,
+                     'used': (fs_stat.f_blocks - fs_stat.f_bfree) * fs_stat.f_frsize,
+                     'avail': fs_stat.f_bavail * fs_stat.f_frsize,
+                     'is_ssd': ok and rotational.strip() == b'0'}))
+    return root_dev
+
+
+def collect_osds():
+    ps_ok, ps_out = run("ps -eo pid,args")
+    meta['ps'] = [ps_ok, to_str(ps_out)]
+    daemons = [line for line in to_str(ps_out).split("\n") if 'ceph-osd' in line]
+
+    for osd_id in params['osds']:
+        path = params['osd_path'].format(osd_id)
+        osd_re = re.compile(r"(--id|-i|--id=|--name osd\.)\s*{0}\b".format(osd_id))
+        osd_running = any(osd_re.search(line) for line in daemons)
+
+        log_cmd = params['osd_log_cmds'].get(str(osd_id))
+        if log_cmd is not None:
+            ok, out = run(log_cmd)
+            emit(path + "log", 'txt', ok, out)
+
+        data_dev = "/var/lib/ceph/osd/ceph-{0}".format(osd_id)
+        jdev = "/var/lib/ceph/osd/ceph-{0}/journal".format(osd_id)
+
+        try:
+            if osd_running and path + "config" not in disabled:
+                cmd = "sudo ceph -f json --admin-daemon /var/run/ceph/ceph-osd.{0}.asok config show"
+                ok, data = run(cmd.format(osd_id))
+                emit(path + "config", 'json', ok, data)
+                if ok:
+                    osd_cfg = json.loads(to_str(data))
+                    data_dev = str(osd_cfg.get('osd_data', data_dev))
+                    jdev = str(osd_cfg.get('osd_journal', jdev))
+
+            if path + "storage_ls" not in disabled:
+                ls_path = os.path.join(data_dev, 'current')
+                try:
+                    emit(path + "storage_ls", 'txt', True, "\n".join(sorted(os.listdir(ls_path))) + "\n")
+                except OSError as exc:
+                    emit(path + "storage_ls", 'txt', False, str(exc))
+
+            meta['osd_devs'][osd_id] = [emit_device_info(path + "data", data_dev),
+                                        emit_device_info(path + "journal", jdev)]
+        except Exception as exc:
+            meta['errors'].append("osd-{0}: {1!r}".format(osd_id, exc))
+
+
+def main():
+    for part, func in (('node_commands', collect_node), ('osds', collect_osds)):
+        if params.get(part):
+            try:
+                func()
+            except Exception as exc:
+                meta['errors'].append("{0}: {1!r}".format(part, exc))
+
+    for path, fname in params['rusage']:
+        ok, out = read(fname)
+        emit(path, 'txt', ok, out)
+
+    emit('__meta__', 'json', True, json.dumps(meta))
+
+    bundle = []
+    for path, frmt, ok, data in records:
+        bundle.append(json.dumps([path, frmt, ok, len(data)]).encode('utf8') + b"\n")
+        bundle.append(data)
+
+    getattr(sys.stdout, 'buffer', sys.stdout).write(zlib.compress(b"".join(bundle), 6))
+
+
+main()
+"""
+
+# run agent with any available python, code is passed on stdin
+REMOTE_AGENT_CMD = "'exec $(command -v python || command -v python3 || command -v python2) -'"
+
+
+class RemoteAgentCollector(Collector):
+    """Collects all per-host data with one python agent run.
+
+    Agent code is passed to the host over ssh stdin, it gathers node,
+    per-OSD and resource usage data, reading /proc and /sys directly,
+    and returns one zlib-compressed bundle of framed records. Each
+    record is a json header line [path, format, ok, size] followed by
+    size bytes of data. If agent can't be started on host, host data
+    is collected by regular collectors.
+    """
+    name = 'agent'
+
+    # per-OSD results of agent, which may be disabled, relative to OSD path
+    agent_osd_results = ['config', 'storage_ls', 'data/hdparm', 'data/smartctl',
+                         'journal/hdparm', 'journal/smartctl']
+
+    def __init__(self, opts, collect_settings, res_q,
+                 node_collector, ceph_collector, node_resource_collector):
+        Collector.__init__(self, opts, collect_settings, res_q)
+        self.node_collector = node_collector
+        self.ceph_collector = ceph_collector
+        self.node_resource_collector = node_resource_collector
+
+    def replaces(self, collector, role):
+        "True if collector.collect_<role> data is gathered by agent"
+        return (collector is self.node_collector and role == 'node') or \
+            (collector is self.ceph_collector and role == 'osd')
+
+    def collect_node(self, path, host, osd_ids=()):
+        params = {'node_commands': [], 'osds': [], 'rusage': [], 'disabled': [],
+                  'tools_path': TOOLS_PATH, 'unavailable_tools': {}}
+        host_path = 'hosts/' + host + '/'
+
+        cmd_timeout = limit_timeout(self.opts.cmd_timeout)
+        params['cmd_timeout'] = None if cmd_timeout is None else int(cmd_timeout) + 1
+
+        # commands, which can't succeed on this host, are not sent to agent, same as for ssh batches
+        skipped = []
+        if self.node_collector is not None:
+            for path_off, frmt, cmd in self.node_collector.node_commands:
+                if not self.collect_settings.allowed(host_path + path_off):
+                    continue
+                reason = None if HOST_CAPS is None else HOST_CAPS.unavailable(host, cmd)
+                if reason is None:
+                    params['node_commands'].append((host_path + path_off, frmt, cmd))
+                else:
+                    skipped.append((host_path + path_off, cmd, reason))
+
+            if HOST_CAPS is not None:
+                for tool in ('ethtool', 'iwconfig'):
+                    reason = HOST_CAPS.unavailable(host, tool)
+                    if reason is not None:
+                        params['unavailable_tools'][tool] = reason
+
+        # {record path: (log file, cmd)}, log_since output is post-processed by ceph collector
+        log_cmds = {}
+        if self.ceph_collector is not None:
+            params['osds'] = list(osd_ids)
+            params['osd_path'] = path + "/osd/{0}/"
+            params['osd_log_cmds'] = {}
+            for osd_id in osd_ids:
+                opath = params['osd_path'].format(osd_id)
+                params['disabled'].extend(opath + name for name in self.agent_osd_results
+                                          if not self.collect_settings.allowed(opath + name))
+                if self.collect_settings.allowed(opath + "log"):
+                    log_file = self.ceph_collector.osd_log_file.format(osd_id)
+                    cmd = self.ceph_collector.log_cmd(host, log_file)
+                    log_cmds[opath + "log"] = (log_file, cmd)
+                    params['osd_log_cmds'][str(osd_id)] = "bash -c " + pipes.quote(log_since_prologue + cmd)
+
+        if self.node_resource_collector is not None:
+            ctime = int(time.time())
+            params['rusage'] = [('{0}/rusage/{1}/{2}-disk'.format(path, host, ctime), "/proc/diskstats"),
+                                ('{0}/rusage/{1}/{2}-net'.format(path, host, ctime), "/proc/net/dev")]
+
+        code = remote_agent_code_templ.replace('__params__', repr(json.dumps(params)))
+        ok, out = check_output_ssh(host, self.opts, REMOTE_AGENT_CMD, input_data=code)
 
-        open(local_file, "w").write(performance_monitor_code)
         try:
-            scp_cmd = "scp {0} {1} {2}:{3}".format(SSH_OPTS, local_file,
-                                                   host, self.remote_file)
+            assert ok, out
+            records = self.unpack_bundle(out)
+        except Exception as exc:
+            logger.warning("Agent failed on node %s: %s. Fallback to per-command collection", host, exc)
+            self.collect_node_fallback(path, host, osd_ids)
+            return
 
-            ok, _ = check_output(scp_cmd)
-            assert ok
+        meta = json.loads(records.pop()[3])
+        for rec_path, frmt, ok, data in records:
+            if rec_path in log_cmds:
+                log_file, cmd = log_cmds[rec_path]
+                self.ceph_collector.emit_log(host, rec_path, log_file, cmd, ok, data)
+            else:
+                self.emit(rec_path, frmt, ok, data)
+
+        for rec_path, cmd, reason in skipped:
+            logger.debug("Cmd %s skipped on node %s: %s", cmd, host, reason)
+            self.emit(rec_path, 'txt', False, Unavailable(reason))
+
+        for msg in meta['errors']:
+            logger.warning("Agent on node %s: %s", host, msg)
+
+        if self.node_collector is not None:
+            interfaces = {}
+            for dev, info in meta['interfaces'].items():
+                dev = str(dev)
+                interfaces[dev] = {'dev': dev, 'is_phy': info['is_phy']}
+                if info['is_phy']:
+                    self.node_collector.fill_interface_speed(host, interfaces[dev],
+                                                             info['ethtool'], info['iwconfig'])
+            self.emit(host_path + 'interfaces', 'json', True, json.dumps(interfaces))
+
+        if self.ceph_collector is not None and 'ps' in meta:
+            snapshot = PROCESS_SNAPSHOTS.add(host, meta['ps'][0], str(meta['ps'][1]))
+            self.ceph_collector.emit_daemons(path, host, osd_ids, snapshot)
+
+        if self.ceph_collector is not None:
+            with self.ceph_collector.osd_devs_lock:
+                for osd_id, (data_root_dev, jroot_dev) in meta['osd_devs'].items():
+                    self.ceph_collector.osd_devs[int(osd_id)] = (host, str(data_root_dev), str(jroot_dev))
+
+    def unpack_bundle(self, data):
+        "returns list of (path, format, ok, data) records, meta record is the last one"
+        data = zlib.decompress(data)
+        records = []
+        pos = 0
+        while pos < len(data):
+            eol = data.index("\n", pos)
+            path, frmt, ok, size = json.loads(data[pos:eol])
+            pos = eol + 1 + size
+            records.append((str(path), str(frmt), ok, data[eol + 1: pos]))
+
+        assert len(records) != 0 and records[-1][0] == '__meta__', "No meta record in agent bundle"
+        return records
+
+    def collect_node_fallback(self, path, host, osd_ids):
+        if self.node_resource_collector is not None:
+            wait_item(self.node_resource_collector.collect_node(path, host))
+
+        if self.node_collector is not None:
+            wait_item(self.node_collector.collect_node(path, host))
+
+        if self.ceph_collector is not None and len(osd_ids) != 0:
+            self.ceph_collector.collect_osd(path, host, osd_ids)
+
+
+# options, passed from master to relays as is
+RELAY_OPTIONS = ["--collectors", "--disable", "--log-level", "--engine", "--pool-size", "--no-adaptive",
+                 "--ssh-check-concurrency", "--cmd-timeout", "--ssh-conn-timeout", "--compress-threshold",
+                 "--host-max-failures", "--max-host-concurrency", "--no-host-caps", "--log-offsets",
+                 "--ceph-log-max-lines", "--ceph-log-max-bytes", "--log-filter", "--log-severity",
+                 "--performance-collect-seconds", "--usage-collect-interval", "--no-pretty-json",
+                 "--agent", "--no-batch", "--no-ssh-pool"]
+
+# options with nargs, all values follow one flag
+RELAY_NARGS_OPTIONS = ["--disable"]
+
+# relay gets this time to send and master to merge sub-archive before collection deadline
+RELAY_DEADLINE_RESERVE = 30
+
+# relay unpacks tar from stdin into temporary dir and runs collector code from it with python2,
+# tar has the code and, for incremental run, base manifest of relay hosts
+RELAY_CMD_TEMPL = "d=$(mktemp -d) && tar -xf - -C $d && {{ $(command -v python2 || command -v python) " + \
+                  "$d/collect_info.py {0} ; code=$? ; rm -rf $d ; exit $code ; }}"
+
+RELAY_BASE_NAME = "base.tar"
+
+
+def relay_source():
+    "returns code of this script to run on relays, None if it's not run from file"
+    fname = globals().get('__file__')
+    if fname is None or not fname.endswith(('.py', '.pyc')):
+        return None
+    try:
+        return open(fname[:-1] if fname.endswith('.pyc') else fname, 'rb').read()
+    except IOError:
+        return None
+
+
+def tar_data(members):
+    "returns uncompressed tar archive with {name: data} members"
+    buf = cStringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data in sorted(members.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0644
+            tar.addfile(info, cStringIO.StringIO(data))
+    return buf.getvalue()
+
+
+class RelayCollector(Collector):
+    """Collects data of all hosts from CRUSH bucket by collector, started on one host of it.
+
+    This script is copied to relay over ssh stdin and run there with
+    the bucket hosts and their roles, relay collects them as master does,
+    but without ceph queries, and streams back one sub-archive. Master keeps
+    it on disk and merges its results into own archive, relay trace is merged
+    into master one. If relay fails, hosts of bucket are remembered in failed
+    and collected by master itself.
+
+    Incremental run passes manifest of base results of bucket hosts to relay,
+    results, which relay didn't archive as unchanged, are taken from its manifest.
+    """
+    name = 'relay'
+
+    # sub-archive members, which describe relay run and aren't results
+    run_info = ('log.txt',)
+
+    def __init__(self, opts, collect_settings, res_q, source, tmp_dir):
+        Collector.__init__(self, opts, collect_settings, res_q)
+        self.source = source
+        self.tmp_dir = tmp_dir
+        self.lock = threading.Lock()
+        # {bucket: plan} of failed relays
+        self.failed = {}
+        self.bad_hosts = []
+        self.skipped = []
+
+    def relay_argv(self, plan):
+        argv = ["--relay-plan", json.dumps(plan), "--result", "-", "--compress", "gzip"]
+
+        for flag in RELAY_OPTIONS:
+            val = getattr(self.opts, flag[2:].replace('-', '_'))
+            if val is None or val is False or val == []:
+                continue
+            elif val is True:
+                argv.append(flag)
+            elif flag in RELAY_NARGS_OPTIONS:
+                argv.append(flag)
+                argv.extend(val)
+            elif isinstance(val, list):
+                for item in val:
+                    argv.extend([flag, item])
+            else:
+                argv.extend([flag, str(val)])
+
+        timeout = limit_timeout()
+        if timeout is not None:
+            argv.extend(["--max-runtime", str(max(int(timeout) - RELAY_DEADLINE_RESERVE, 1))])
+
+        argv = " ".join(pipes.quote(arg) for arg in argv)
+        if INCREMENTAL_BASE is not None:
+            # base is unpacked on relay into temporary dir $d, see RELAY_CMD_TEMPL
+            argv += " --incremental-from $d/" + RELAY_BASE_NAME
+        return argv
+
+    def relay_input(self, plan):
+        "tar with this script and, for incremental run, base manifest of plan hosts results"
+        members = {'collect_info.py': self.source}
+        if INCREMENTAL_BASE is not None:
+            prefixes = tuple("hosts/{0}/".format(host) for host in plan['node'])
+            files = {fname: entry for fname, entry in INCREMENTAL_BASE.files.items()
+                     if fname.startswith(prefixes)}
+            manifest = json.dumps({'run_id': INCREMENTAL_BASE.run_id, 'files': files})
+            members[RELAY_BASE_NAME] = tar_data({MANIFEST_NAME: manifest})
+        return tar_data(members)
+
+    def collect_relay(self, path, host, bucket, plan):
+        cmd = RELAY_CMD_TEMPL.format(self.relay_argv(plan))
+        fname = os.path.join(self.tmp_dir, "relay_{0}.tar.gz".format(hashlib.md5(bucket).hexdigest()))
+        logger.info("Start relay on %s for %s hosts of %r", host, len(plan['node']), bucket)
+
+        t1 = time.time()
+        try:
+            code, err = self.run_relay(host, cmd, self.relay_input(plan), fname)
+            if code != 0:
+                raise RuntimeError("relay exited with code {0}: {1}".format(code, err.strip()[-1000:]))
+            size = os.stat(fname).st_size
+            self.merge(host, bucket, fname, t1)
+        except Exception as exc:
+            logger.warning("Relay %s for %r failed: %s. Hosts of it would be collected directly",
+                           host, bucket, exc)
+            with self.lock:
+                self.failed[bucket] = plan
+            return
         finally:
-            os.unlink(local_file)
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+        TRACER.add("relay " + host, 'transport', t1, time.time(), host=host, bucket=bucket, bytes=size)
+        logger.info("Relay %s for %r done in %.1fs, %s bytes received", host, bucket, time.time() - t1, size)
+
+    def run_relay(self, host, cmd, input_data, fname):
+        """run relay with ssh, input_data is passed on its stdin, sub-archive is streamed
+        into fname, returns (exit code, stderr), relay is killed at collection deadline"""
+        timeout = limit_timeout()
+        ssh_cmd = "ssh {0} {1} {2}".format(ssh_host_opts(host), host, pipes.quote(cmd))
+        logger.debug("SSH:%s: relay %r", host, cmd)
+
+        with open(fname, "wb") as out_fd:
+            with tempfile.TemporaryFile() as err_fd:
+                p = subprocess.Popen(ssh_cmd, shell=True,
+                                     stdin=subprocess.PIPE,
+                                     stdout=out_fd,
+                                     stderr=err_fd,
+                                     close_fds=True,
+                                     preexec_fn=os.setpgrp)
+
+                if timeout is not None:
+                    killer = threading.Timer(timeout, kill_process_group, (p,))
+                    killer.daemon = True
+                    killer.start()
+
+                p.communicate(input_data)
+                code = p.wait()
+
+                if timeout is not None:
+                    killer.cancel()
+
+                err_fd.seek(0)
+                return code, err_fd.read()
+
+    def merge(self, host, bucket, fname, t_start):
+        """put results from sub-archive to res_q, hardlinked results are read from their targets.
+        t_start - time, when relay was started"""
+        manifest = None
+        with tarfile.open(fname) as tar:
+            members = [member for member in tar if member.isfile() or member.islnk()]
+            if len(members) == 0:
+                raise ValueError("empty sub-archive")
+
+            for member in members:
+                data = tar.extractfile(member).read()
+                path, frmt = member.name.rsplit('.', 1)
+
+                if member.name in self.run_info:
+                    self.res_q.put((True, "relays/{0}/{1}".format(bucket, path), frmt, data))
+                elif member.name == 'trace.json':
+                    TRACER.merge(data, t_start, "relay " + host, host=host, relay=host)
+                elif member.name == MANIFEST_NAME:
+                    manifest = json.loads(data)
+                elif member.name == 'bad_hosts.json':
+                    with self.lock:
+                        self.bad_hosts.extend(json.loads(data))
+                elif member.name == 'skipped_items.json':
+                    with self.lock:
+                        self.skipped.extend(json.loads(data))
+                elif member.name == 'collection_cost.json':
+                    REMOTE_USAGE.merge(json.loads(data))
+                elif member.name == 'json_format.txt':
+                    continue
+                else:
+                    self.res_q.put((frmt != 'err', path, frmt, data))
 
-        start_cmd = 'screen -S ceph_monitor -d -m bash ' + self.remote_file
-        check_output_ssh(host, self.opts, start_cmd, no_retry=True)
+        if INCREMENTAL_BASE is not None and manifest is not None:
+            self.merge_unchanged(manifest)
 
-    def collect_performance_data(self, path, host):
-        all_files = {'io': self.io_file,
-                     'cpu': self.cpu_file,
-                     'net': self.net_file}
+    def merge_unchanged(self, manifest):
+        "put results, which relay found the same as in base and didn't archive, to res_q"
+        for fname, entry in manifest['files'].items():
+            base_entry = INCREMENTAL_BASE.files.get(fname)
+            if entry['run'] == manifest['run_id'] or base_entry is None:
+                continue
 
-        for tp, fname in all_files.items():
-            self.ssh2emit(host,
-                          "{0}/perf_monitoring/{1}/{2}".format(path, host, tp),
-                          "txt", 'cat ' + fname)
-        check_output_ssh(host, self.opts, "rm -f " +
-                         " ".join(all_files.values() + [self.remote_file]),
-                         no_retry=True)
+            path, frmt = fname.rsplit('.', 1)
+            validated_at = None if entry['at'] == base_entry['at'] else entry['at']
+            self.res_q.put((True, path, frmt, UnchangedResult(entry['md5'], validated_at)))
 
 
 class CephDiscovery(object):
     def __init__(self, opts):
         self.opts = opts
-        self.ceph_cmd = "ceph -c {0.conf} -k {0.key} --format json ".format(self.opts)
+        # {ceph cmd: (ok, out)}, reused by master collector
+        self.results = {}
+
+    def run_ceph(self, cmd):
+        self.results[cmd] = ceph_query(self.opts, cmd)
+        return self.results[cmd]
 
     def discover(self):
-        ok, res = check_output(self.ceph_cmd + "mon_status")
+        ok, res = self.run_ceph("mon_status")
         assert ok
         for node in json.loads(res)['monmap']['mons']:
             yield 'monitor', str(node['name']), {'name': node['name']}
 
-        ok, res = check_output(self.ceph_cmd + "osd tree")
+        ok, res = self.run_ceph("osd tree")
         assert ok
         for node in json.loads(res)['nodes']:
-            if node['type'] == 'host':
-                for osd_id in node['children']:
-                    yield 'osd', str(node['name']), {'osd_id': osd_id}
+            if node['type'] == 'host' and len(node['children']) != 0:
+                # osd's are collected per host
+                yield 'osd', str(node['name']), {'osd_ids': node['children']}
+
+
+def gzip_block(data, level):
+    cobj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return cobj.compress(data) + cobj.flush()
+
+
+def cli_block(cmd, data):
+    # not check_output, as archive must be compressed after collection deadline too
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise RuntimeError("{0!r} failed: {1}".format(cmd, err.strip()))
+    return out
+
+
+# codec: (archive extension, default level, command line tool)
+ARCHIVE_CODECS = {
+    'gzip': ('gz', 6, 'gzip'),
+    'xz': ('xz', 6, 'xz'),
+    'zstd': ('zst', 3, 'zstd'),
+    'lz4': ('lz4', 1, 'lz4'),
+}
 
 
-def save_results_th_func(opts, res_q, out_folder):
+def get_block_compressor(codec, level):
+    """returns func(data) -> compressed data, which can be concatenated with other blocks.
+    Python module is used if available, command line tool otherwise"""
+    if codec == 'gzip':
+        return lambda data: gzip_block(data, level)
+
     try:
+        if codec == 'xz':
+            try:
+                import lzma
+            except ImportError:
+                from backports import lzma
+            return lambda data: lzma.compress(data, preset=level)
+        elif codec == 'zstd':
+            import zstandard
+            # compressor objects can't be shared between threads
+            return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+        elif codec == 'lz4':
+            import lz4.frame
+            return lambda data: lz4.frame.compress(data, compression_level=level)
+    except ImportError:
+        pass
+
+    tool = ARCHIVE_CODECS[codec][2]
+    if not check_output("which " + tool, False)[0]:
+        raise ValueError("Neither python module nor {0!r} tool is available for {1} compression"
+                         .format(tool, codec))
+
+    cmd = "{0} -c -{1}".format(tool, level)
+    return lambda data: cli_block(cmd, data)
+
+
+class ParallelCompressor(object):
+    """File-like object, which compresses written data in blocks with thread pool
+    and writes compressed blocks to fileobj in original order.
+
+    Concatenated gzip members, xz streams, zstd and lz4 frames are valid
+    compressed files, so result is readable by usual tools
+    """
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, fileobj, compress_block, threads):
+        self.fileobj = fileobj
+        self.compress_block = compress_block
+        self.buf = []
+        self.buf_size = 0
+        self.raw_size = 0
+        self.compressed_size = 0
+
+        # [done event, compressed data or exception] for each block in write order
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        self.in_q = Queue.Queue()
+        self.workers = []
+        for _ in range(threads):
+            th = threading.Thread(target=self.worker)
+            th.daemon = True
+            th.start()
+            self.workers.append(th)
+
+    def worker(self):
         while True:
-            val = res_q.get()
+            val = self.in_q.get()
             if val is None:
-                break
+                return
+
+            data, slot = val
+            try:
+                slot[1] = self.compress_block(data)
+            except Exception as exc:
+                slot[1] = exc
+            slot[0].set()
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= self.block_size:
+            self.submit()
+
+    def submit(self):
+        data = "".join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        if len(data) == 0:
+            return
+
+        self.raw_size += len(data)
+        slot = [threading.Event(), None]
+        self.pending.append(slot)
+        self.in_q.put((data, slot))
+        self.write_ready()
+
+    def write_ready(self, wait_all=False):
+        "write compressed blocks, waits for oldest block if too many blocks are in flight"
+        while len(self.pending) != 0:
+            slot = self.pending[0]
+            if not slot[0].is_set():
+                if not wait_all and len(self.pending) <= self.max_pending:
+                    return
+                slot[0].wait()
+
+            self.pending.popleft()
+            if isinstance(slot[1], Exception):
+                raise slot[1]
+
+            self.fileobj.write(slot[1])
+            self.compressed_size += len(slot[1])
+
+    def close(self):
+        self.submit()
+        self.write_ready(wait_all=True)
+        for _ in self.workers:
+            self.in_q.put(None)
+        for th in self.workers:
+            th.join()
+
+        logger.info("Archive compressed from %s to %s bytes with %s threads",
+                    self.raw_size, self.compressed_size, len(self.workers))
+
+
+class SpilledResult(object):
+    "Result data, kept in temporary file instead of memory"
+    def __init__(self, fname, size):
+        self.fname = fname
+        self.size = size
+
+    def open(self):
+        return open(self.fname, "rb")
+
+    def read(self):
+        with self.open() as fd:
+            return fd.read()
+
+    def remove(self):
+        try:
+            os.unlink(self.fname)
+        except OSError:
+            pass
+
+
+class ResultQueue(object):
+    """Bounded queue of collected results, waiting for archive writer
+
+    put blocks while queued results take more than max_bytes of memory, so
+    slow archiving throttles collectors instead of growing memory usage.
+    Outputs bigger than spill_threshold are written to files in spill_dir and
+    queued as SpilledResult, which takes no queue memory.
+
+    Reactor loop must not block, so results, put from its callbacks, are
+    handed to handoff thread, which puts them in the usual way. They are
+    throttled by wait_not_full, which run_all calls before starting new item.
+    """
+    def __init__(self, max_bytes, spill_threshold, spill_dir):
+        self.max_bytes = max_bytes
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.cond = threading.Condition()
+        self.items = collections.deque()
+        self.mem_bytes = 0
+        self.peak_bytes = 0
+        self.spilled = 0
+        self.spilled_bytes = 0
+        self.blocked_time = 0.0
+        # results from reactor thread, not yet put, and their total size
+        self.handoff = collections.deque()
+        self.handoff_bytes = 0
+        self.handoff_thread = threading.Thread(target=self.handoff_loop, name="result handoff")
+        self.handoff_thread.daemon = True
+        self.handoff_thread.start()
+
+    @staticmethod
+    def data_size(val):
+        return len(val[3]) if val is not None and isinstance(val[3], basestring) else 0
+
+    def handoff_loop(self):
+        while True:
+            with self.cond:
+                while len(self.handoff) == 0:
+                    self.cond.wait()
+                val = self.handoff[0]
+
+            self.put(val)
+
+            with self.cond:
+                self.handoff.popleft()
+                self.handoff_bytes -= self.data_size(val)
+                self.cond.notify_all()
+
+    def wait_not_full(self):
+        "wait till queued and handed off results take less than max_bytes"
+        with self.cond:
+            t1 = time.time()
+            while self.mem_bytes + self.handoff_bytes > self.max_bytes and \
+                    (len(self.items) != 0 or len(self.handoff) != 0):
+                self.cond.wait()
+            t2 = time.time()
+            self.blocked_time += t2 - t1
+            if t2 - t1 > 0.001:
+                TRACER.add("result queue full", 'queue', t1, t2)
+
+    def spill(self, data):
+        fd, fname = tempfile.mkstemp(dir=self.spill_dir)
+        with os.fdopen(fd, "wb") as spill_fd:
+            spill_fd.write(data)
+
+        with self.cond:
+            self.spilled += 1
+            self.spilled_bytes += len(data)
+
+        return SpilledResult(fname, len(data))
+
+    def put(self, val):
+        if REACTOR is not None and REACTOR.in_loop():
+            with self.cond:
+                self.handoff.append(val)
+                self.handoff_bytes += self.data_size(val)
+                self.cond.notify_all()
+            return
 
+        if val is None:
+            # end of data marker goes after all handed off results
+            with self.cond:
+                while len(self.handoff) != 0:
+                    self.cond.wait()
+
+        # end of data marker never blocks
+        size = 0
+        if val is not None and isinstance(val[3], basestring):
             ok, path, frmt, out = val
+            if isinstance(out, unicode):
+                out = out.encode('utf8')
+
+            if len(out) > self.spill_threshold:
+                out = self.spill(out)
+            else:
+                size = len(out)
+            val = (ok, path, frmt, out)
+
+        with self.cond:
+            t1 = time.time()
+            while len(self.items) != 0 and self.mem_bytes + size > self.max_bytes:
+                self.cond.wait()
+            t2 = time.time()
+            self.blocked_time += t2 - t1
+            if t2 - t1 > 0.001:
+                TRACER.add("result queue full", 'queue', t1, t2)
+
+            self.items.append((val, size))
+            self.mem_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.mem_bytes)
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while len(self.items) == 0:
+                self.cond.wait()
+
+            val, size = self.items.popleft()
+            self.mem_bytes -= size
+            self.cond.notify_all()
+            return val
+
+    def qsize(self):
+        with self.cond:
+            return len(self.items)
+
+    def log(self):
+        logger.info("Result queue: peak %s bytes in memory, %s outputs with %s bytes spilled " +
+                    "to disk, collectors waited for writer %.1fs", self.peak_bytes,
+                    self.spilled, self.spilled_bytes, self.blocked_time)
+
+
+class ArchiveWriter(object):
+    """Appends results to tar.gz stream as they arrive, without temporary folder
+
+    compressor - ParallelCompressor, which writes to result file,
+    unpacked_folder - if given, results are also saved there as plain files
+    Thread safe, members are written one by one.
+    """
+    def __init__(self, compressor, unpacked_folder=None):
+        self.lock = threading.Lock()
+        self.compressor = compressor
+        self.tar = tarfile.open(fileobj=compressor, mode='w|')
+        self.unpacked_folder = unpacked_folder
+        self.members = 0
+        self.links = 0
+        self.size = 0
+
+    def add(self, fname, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        self.add_file(fname, cStringIO.StringIO(data), len(data))
+
+    def add_file(self, fname, fileobj, size):
+        "stream size bytes from fileobj into archive, without reading all data into memory"
+        info = tarfile.TarInfo(fname)
+        info.size = size
+        info.mtime = time.time()
+        info.mode = 0644
+        with self.lock:
+            self.tar.addfile(info, fileobj)
+            self.members += 1
+            self.size += size
+
+        if self.unpacked_folder is not None:
+            full_path = os.path.join(self.unpacked_folder, fname)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            fileobj.seek(0)
+            with open(full_path, "wb") as fd:
+                shutil.copyfileobj(fileobj, fd)
+
+    def add_link(self, fname, target):
+        "add fname as hardlink to already archived target, so equal data is stored once"
+        info = tarfile.TarInfo(fname)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target
+        info.mtime = time.time()
+        info.mode = 0644
+        with self.lock:
+            self.tar.addfile(info)
+            self.members += 1
+            self.links += 1
+
+        if self.unpacked_folder is not None:
+            full_path = os.path.join(self.unpacked_folder, fname)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            os.link(os.path.join(self.unpacked_folder, target), full_path)
+
+    def close(self):
+        self.tar.close()
+        self.compressor.close()
+        logger.debug("%s results with %s bytes of data archived, %s of them as links to equal results",
+                     self.members, self.size, self.links)
+
+
+# json outputs smaller than this are prettified in writer thread itself
+JSON_POOL_THRESHOLD = 64 * 1024
+
+
+def ignore_sigint():
+    "json pool worker initializer, interruption is handled by main process"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class JSONPool(object):
+    """Processes to prettify big json outputs
+
+    Must be created before any thread is started and any subprocess pipe is
+    opened: forked workers would inherit write ends of stdin pipes of ssh
+    commands, so remote side, reading stdin till EOF (agent, relays), would hang.
+    """
+    def __init__(self, processes):
+        self.pool = multiprocessing.Pool(processes, ignore_sigint)
+
+    def apply(self, func, args):
+        return self.pool.apply(func, args)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def normalize_json(data, json_pool=None):
+    """returns prettified json or data as is, if it isn't a valid json
+
+    json module holds GIL, so big outputs are prettified in json_pool processes
+    """
+    if json_pool is not None and len(data) > JSON_POOL_THRESHOLD:
+        return json_pool.apply(normalize_json, (data,))
+
+    try:
+        return json.dumps(json.loads(data), indent=4, sort_keys=True)
+    except Exception:
+        return data
+
+
+class WriteStats(object):
+    "Accounts time, spent to format and to archive each result"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = []
+
+    def add(self, fname, size, format_time, write_time):
+        logger.debug("Archived %s: %s bytes, format %.3fs, write %.3fs",
+                     fname, size, format_time, write_time)
+        with self.lock:
+            self.members.append((format_time + write_time, format_time, write_time, fname))
+
+    def log(self, top=5):
+        logger.info("Archived %s results: format %.1fs, write %.1fs total",
+                    len(self.members),
+                    sum(format_time for _, format_time, _, _ in self.members),
+                    sum(write_time for _, _, write_time, _ in self.members))
+
+        for _, format_time, write_time, fname in sorted(self.members, reverse=True)[:top]:
+            logger.info("    %s: format %.3fs, write %.3fs", fname, format_time, write_time)
+
+
+# archive compression magic bytes and command to decompress it to stdout
+ARCHIVE_MAGICS = [
+    ('\x1f\x8b', 'gzip -dc'),
+    ('\xfd7zXZ\x00', 'xz -dc'),
+    ('\x28\xb5\x2f\xfd', 'zstd -dc'),
+    ('\x04\x22\x4d\x18', 'lz4 -dc'),
+]
+
+
+def read_archive_member(arch_name, member):
+    "returns data of one member of collect_info archive, compressed with any supported codec"
+    magic = open(arch_name, 'rb').read(6)
+    for prefix, decompress_cmd in ARCHIVE_MAGICS:
+        if magic.startswith(prefix):
+            break
+    else:
+        decompress_cmd = 'cat'
+
+    ok, out = check_output("{0} {1} | tar -xOf - {2}".format(decompress_cmd, arch_name, member), False)
+    if not ok:
+        raise ValueError("Can't read {0} from {1}: {2}".format(member, arch_name, out.strip()))
+    return out
+
+
+def file_md5(fd, block_size=1024 ** 2):
+    md5 = hashlib.md5()
+    for block in iter(lambda: fd.read(block_size), ""):
+        md5.update(block)
+    return md5.hexdigest()
+
 
-            while '//' in path:
-                path.replace('//', '/')
+MANIFEST_NAME = "manifest.json"
 
-            while path.startswith('/'):
-                path = path[1:]
 
-            while path.endswith('/'):
-                path = path[:-1]
+class IncrementalBase(object):
+    """Manifest of previous archive, which incremental run is based on
 
-            fname = os.path.join(out_folder, path + '.' + frmt)
-            dr = os.path.dirname(fname)
+    Results with ttl, younger than it, are reused without collecting,
+    older ones with known md5 are revalidated on remote side.
+    """
+    def __init__(self, arch_name):
+        self.arch_name = arch_name
+        manifest = json.loads(read_archive_member(arch_name, MANIFEST_NAME))
+        self.run_id = manifest['run_id']
+        self.files = manifest['files']
 
-            if not os.path.exists(dr):
-                os.makedirs(dr)
+    def fresh(self, fname):
+        entry = self.files.get(fname)
+        return entry is not None and time.time() - entry['at'] < entry['ttl']
 
-            if frmt == 'bin':
-                open(fname, "wb").write(out)
-            elif frmt == 'json':
-                if not opts.no_pretty_json:
-                    try:
-                        out = json.dumps(json.loads(out), indent=4, sort_keys=True)
-                    except Exception:
-                        pass
-                open(fname, "w").write(out)
+    def md5(self, fname):
+        entry = self.files.get(fname)
+        return None if entry is None else entry['md5']
+
+    def unchanged(self, fname):
+        return UnchangedResult(self.files[fname]['md5'])
+
+
+# This variable is updated from main function
+INCREMENTAL_BASE = None
+
+
+class ResultManifest(object):
+    """md5, size, check time and ttl of every result of the run, saved into archive
+
+    Results, equal to base ones, aren't archived again. Entry field 'run' is
+    id of the run, which archive keeps result data, so delta archive is
+    overlaid on archives of all runs it refers to.
+    Results, equal to already archived ones of this run, are archived as
+    hardlinks, entry field 'ref' is name of result with the same data.
+    """
+    def __init__(self, base=None):
+        self.run_id = str(uuid.uuid4())
+        self.base = base
+        self.lock = threading.Lock()
+        self.files = {}
+        self.stored = {}
+        self.reused = 0
+        self.revalidated = 0
+        self.same = 0
+        self.dedup_bytes = 0
+
+    def add(self, fname, md5, size):
+        "returns False, if base archive has the same data"
+        entry = {'md5': md5, 'size': size, 'at': time.time(),
+                 'ttl': NodeCollector.static_ttl(fname), 'run': self.run_id}
+
+        base_entry = None if self.base is None else self.base.files.get(fname)
+        if base_entry is not None and base_entry['md5'] == md5:
+            entry['run'] = base_entry['run']
+
+        with self.lock:
+            self.files[fname] = entry
+            if entry['run'] != self.run_id:
+                self.same += 1
+
+        return entry['run'] == self.run_id
+
+    def stored_as(self, md5):
+        "name of archived result of this run with given md5, or None"
+        with self.lock:
+            return self.stored.get(md5)
+
+    def add_stored(self, fname, md5):
+        "data of fname is in archive, so later equal results may refer to it"
+        with self.lock:
+            self.stored.setdefault(md5, fname)
+
+    def add_ref(self, fname, target):
+        with self.lock:
+            self.files[fname]['ref'] = target
+            self.dedup_bytes += self.files[fname]['size']
+
+    def add_unchanged(self, fname, res):
+        entry = self.base.files[fname].copy()
+        if res.validated_at is not None:
+            entry['at'] = res.validated_at
+
+        with self.lock:
+            self.files[fname] = entry
+            if res.validated_at is None:
+                self.reused += 1
             else:
-                open(fname, "w").write(out)
-    except Exception:
-        logger.exception("In save_results_th_func thread")
+                self.revalidated += 1
+
+    def dumps(self):
+        return json.dumps({'run_id': self.run_id,
+                           'base_run_id': None if self.base is None else self.base.run_id,
+                           'files': self.files})
+
+    def log(self):
+        refs = sum(1 for entry in self.files.values() if 'ref' in entry)
+        logger.info("%s results are archived as links to equal ones, %s bytes deduplicated",
+                    refs, self.dedup_bytes)
+
+        if self.base is not None:
+            logger.info("Incremental run over %r: %s results reused, %s revalidated remotely, " +
+                        "%s equal to base, %s archived", self.base.arch_name, self.reused,
+                        self.revalidated, self.same,
+                        len(self.files) - self.reused - self.revalidated - self.same)
+
+
+def save_results_th_func(opts, res_q, writer, stats, manifest, json_pool=None):
+    """archive worker: takes results from res_q till None, several workers may share res_q and writer.
+    Failed result is logged and skipped, worker must drain res_q anyway, or collectors would block on it"""
+    while True:
+        val = res_q.get()
+        if val is None:
+            # let other workers stop too
+            res_q.put(None)
+            break
+
+        try:
+            save_result(opts, val, writer, stats, manifest, json_pool)
+        except Exception:
+            logger.exception("Can't archive result %r", val[1])
+
+
+def write_result(writer, manifest, fname, md5, out, spilled=None):
+    "archive result data, from spilled file if given, or as link to equal result of this run"
+    # link target must be in archive before link, so results are
+    # registered as stored only after they are written
+    target = manifest.stored_as(md5)
+    if target is not None:
+        writer.add_link(fname, target)
+        manifest.add_ref(fname, target)
+        return
+
+    if spilled is not None:
+        with spilled.open() as fd:
+            writer.add_file(fname, fd, spilled.size)
+    else:
+        writer.add(fname, out)
+    manifest.add_stored(fname, md5)
+
+
+def save_result(opts, val, writer, stats, manifest, json_pool=None):
+    "archive one (ok, path, format, data) result"
+    ok, path, frmt, out = val
+
+    while '//' in path:
+        path = path.replace('//', '/')
+
+    while path.startswith('/'):
+        path = path[1:]
+
+    while path.endswith('/'):
+        path = path[:-1]
+
+    fname = path + '.' + frmt
+    if isinstance(out, UnchangedResult):
+        manifest.add_unchanged(fname, out)
+        return
+
+    pretty = frmt == 'json' and not opts.no_pretty_json
+    spilled = out if isinstance(out, SpilledResult) else None
+
+    try:
+        t1 = time.time()
+        if pretty:
+            if spilled is not None:
+                out = spilled.read()
+            out = normalize_json(out, json_pool)
+
+        if spilled is not None and not pretty:
+            with spilled.open() as fd:
+                md5 = file_md5(fd)
+            size = spilled.size
+        else:
+            if isinstance(out, unicode):
+                out = out.encode('utf8')
+            md5 = hashlib.md5(out).hexdigest()
+            size = len(out)
+        changed = manifest.add(fname, md5, size)
+        t2 = time.time()
+        if changed:
+            write_result(writer, manifest, fname, md5, out, None if pretty else spilled)
+    finally:
+        if spilled is not None:
+            spilled.remove()
+
+    t3 = time.time()
+    TRACER.add("format", 'writer', t1, t2, path=fname, bytes=size)
+    TRACER.add("write", 'writer', t2, t3, path=fname, bytes=size)
+    stats.add(fname, size, t2 - t1, t3 - t2)
+
+
+def crush_buckets(osd_tree, bucket_type):
+    "returns {bucket name: [host]} for all hosts from 'osd tree' output, placed into buckets of bucket_type"
+    nodes = json.loads(osd_tree)['nodes']
+    parents = {}
+    for node in nodes:
+        for child_id in node.get('children', []):
+            parents[child_id] = node
+
+    buckets = collections.defaultdict(lambda: [])
+    for node in nodes:
+        if node['type'] != 'host':
+            continue
+        parent = parents.get(node['id'])
+        seen = set()
+        # broken tree may have cycles
+        while parent is not None and parent['type'] != bucket_type and parent['id'] not in seen:
+            seen.add(parent['id'])
+            parent = parents.get(parent['id'])
+        if parent is not None and parent['type'] == bucket_type:
+            buckets[str(parent['name'])].append(str(node['name']))
+    return buckets
+
+
+def plan_relays(opts, nodes, discovered):
+    """returns {bucket: (relay host, plan)}, plan is {role: {host: [kwargs]}} of bucket hosts.
+    Relay is the first of bucket hosts, available over ssh"""
+    ok, osd_tree = discovered["osd tree"]
+    buckets = [(bucket, sorted(hosts))
+               for bucket, hosts in crush_buckets(osd_tree, opts.relay_by).items()
+               if len(hosts) >= opts.relay_min_hosts]
+
+    def find_relay(hosts):
+        for host in hosts:
+            if len(get_sshable_hosts([host], 1, ssh_pool=SSH_POOL)) != 0:
+                return host
+        return None
+
+    relays = {}
+    results = pmap(find_relay, [hosts for _, hosts in buckets], opts.ssh_check_concurrency)
+    for (bucket, hosts), (ok, relay) in zip(buckets, results):
+        if not ok or relay is None:
+            logger.warning("No relay host available for %r, collect its hosts directly", bucket)
+            continue
+
+        plan = {}
+        for role, role_nodes in nodes.items():
+            if role != 'master':
+                plan[role] = {host: role_nodes[host] for host in hosts if host in role_nodes}
+        relays[bucket] = (relay, plan)
+    return relays
 
 
 def discover_nodes(opts):
+    "returns nodes with roles and {ceph cmd: (ok, out)} of discovery commands"
     discovers = [
         CephDiscovery
     ]
 
     nodes = collections.defaultdict(
         lambda: collections.defaultdict(lambda: []))
+    results = {}
 
     for discover_cls in discovers:
         discover = discover_cls(opts)
         for role, node, args in discover.discover():
             nodes[role][node].append(args)
             nodes['node'][node] = [{}]
-    return nodes
+        results.update(discover.results)
+    return nodes, results
+
+
+class CostModel(object):
+    """Expected run time of collection items, learned from previous runs
+
+    Costs are stored per collector function and role, in seconds per unit,
+    unit is one osd for items with osd_ids and whole item for others
+    """
+    # seconds per unit for items without history
+    default_costs = {'master': 30, 'node': 20, 'osd': 10, 'monitor': 5, 'relay': 120}
+    default_cost = 10
+    # weight of last measurement
+    alpha = 0.5
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.costs = {}
+
+        if fname is not None and os.path.exists(fname):
+            try:
+                self.costs = json.load(open(fname))
+            except (IOError, ValueError) as exc:
+                logger.warning("Can't load collection costs from %r: %s", fname, exc)
+
+    @staticmethod
+    def key(func, role):
+        collector = getattr(getattr(func, 'im_self', None), 'name', None)
+        return "{0}.{1}.{2}".format(collector, func.__name__, role)
+
+    @staticmethod
+    def units(kwargs):
+        return max(1, len(kwargs.get('osd_ids', ())))
+
+    def estimate(self, func, role, kwargs):
+        cost = self.costs.get(self.key(func, role), self.default_costs.get(role, self.default_cost))
+        return cost * self.units(kwargs)
+
+    def update(self, func, role, kwargs, dt):
+        key = self.key(func, role)
+        cost = dt / self.units(kwargs)
+        with self.lock:
+            if key in self.costs:
+                cost = self.alpha * cost + (1 - self.alpha) * self.costs[key]
+            self.costs[key] = cost
+
+    def save(self):
+        if self.fname is None:
+            return
+
+        try:
+            with self.lock:
+                data = json.dumps(self.costs, indent=4, sort_keys=True)
+            open(self.fname, "w").write(data)
+        except IOError as exc:
+            logger.warning("Can't save collection costs to %r: %s", self.fname, exc)
+
+
+class AIMDLimiter(object):
+    """Adaptive limit of work items, running in parallel, in AIMD style
+
+    Limit starts from max_limit, the configured concurrency. Failed completion
+    or completion slower than slowdown times of best latency of the same kind
+    of work halves the limit, but not more often than once per round. Good
+    completion grows it by 1 / limit, i.e. by one every round, back to max_limit.
+    Kind identifies the same work, e.g. collector function and role of
+    collection item, its latencies must be per work unit (see CostModel.units),
+    so they are comparable between hosts and items of different size.
+    """
+    slowdown = 3.0
+
+    def __init__(self, name, max_limit):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.best_latency = {}
+        self.since_decrease = 0
+        self.decreases = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                if DEADLINE is not None and time.time() >= DEADLINE:
+                    # let workers see, that there is nothing to do
+                    break
+                self.cond.wait(limit_timeout())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self, kind=None, ok=True, latency=None):
+        "kind is None, if slot wasn't used to do any work"
+        with self.cond:
+            self.in_flight -= 1
+            if kind is not None:
+                self.update(kind, ok, latency)
+            self.cond.notify_all()
+
+    def update(self, kind, ok, latency):
+        best = self.best_latency.get(kind)
+        slow = best is not None and latency > best * self.slowdown
+        self.best_latency[kind] = latency if best is None else min(best, latency)
+        self.since_decrease += 1
+
+        if ok and not slow:
+            self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+        elif self.since_decrease >= self.limit:
+            logger.debug("%s: %s %s, concurrency decreased from %d", self.name, kind,
+                         "is slow" if ok else "failed", int(self.limit))
+            self.limit = max(self.limit / 2, 1.0)
+            self.since_decrease = 0
+            self.decreases += 1
+
+    def log(self):
+        logger.info("%s: concurrency %d at the end, max %d of %d allowed were in flight, %s decreases",
+                    self.name, int(self.limit), self.max_in_flight, self.max_limit, self.decreases)
+
+
+def make_limiter(opts, name, max_limit):
+    "returns AIMDLimiter or None, if concurrency isn't adaptive"
+    if getattr(opts, 'no_adaptive', False):
+        return None
+    return AIMDLimiter(name, max_limit)
+
+
+class CollectScheduler(object):
+    """Queue of collection items, which runs most expensive ones first
+
+    Items are (func, path, node, kwargs, role, cost) tuples. Not more than
+    max_per_host items for the same node are given to workers at once.
+    """
+    def __init__(self, cost_model, max_per_host):
+        self.cost_model = cost_model
+        self.max_per_host = max_per_host
+        self.cond = threading.Condition()
+        # items, sorted by cost descending, and their (-cost, seq) keys
+        self.items = []
+        self.keys = []
+        self.seq = 0
+        self.running = collections.defaultdict(lambda: 0)
+        # [(item, reason)] for items, which was not started
+        self.skipped = []
+
+    def put(self, func, path, node, kwargs, role):
+        cost = self.cost_model.estimate(func, role, kwargs)
+        with self.cond:
+            key = (-cost, self.seq)
+            self.seq += 1
+            pos = bisect.bisect(self.keys, key)
+            self.keys.insert(pos, key)
+            self.items.insert(pos, (func, path, node, kwargs, role, cost))
+            self.cond.notify()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.items)
+
+    def total_cost(self):
+        with self.cond:
+            return sum(item[-1] for item in self.items)
+
+    def get(self):
+        "returns next item, or None if queue is empty or collection deadline reached"
+        with self.cond:
+            while len(self.items) != 0:
+                if DEADLINE is not None and time.time() >= DEADLINE:
+                    logger.warning("Collection deadline reached, %s items skipped", len(self.items))
+                    self.skipped.extend((item, "deadline reached") for item in self.items)
+                    del self.items[:]
+                    del self.keys[:]
+                    break
+
+                pos = 0
+                while pos < len(self.items):
+                    item = self.items[pos]
+                    if HOST_BREAKER is not None and HOST_BREAKER.is_open(item[2]):
+                        self.skipped.append((item, "host unreachable"))
+                        del self.items[pos]
+                        del self.keys[pos]
+                    elif self.running[item[2]] < self.max_per_host:
+                        del self.items[pos]
+                        del self.keys[pos]
+                        self.running[item[2]] += 1
+                        return item
+                    else:
+                        pos += 1
+
+                # all left items are for busy hosts
+                if len(self.items) != 0:
+                    self.cond.wait(limit_timeout())
+            return None
+
+    def done(self, item, dt):
+        func, _, node, kwargs, role, cost = item
+        with self.cond:
+            self.running[node] -= 1
+            self.cond.notify_all()
+
+        self.cost_model.update(func, role, kwargs, dt)
+        logger.debug("%s on %s done in %.2fs, estimated %.2fs",
+                     self.cost_model.key(func, role), node, dt, cost)
+
+
+# time to wait for workers after collection deadline
+DEADLINE_GRACE = 10
+
+
+def run_all(opts, run_q, res_q=None):
+    """run all items from run_q in opts.workers threads. Items, which return
+    Completion, don't keep worker thread till they are done, so not more than
+    opts.pool_size items are in flight. This limit is adapted by AIMDLimiter,
+    unless concurrency isn't adaptive. New items aren't started, while res_q is full"""
+    limiter = make_limiter(opts, "Collection", opts.pool_size)
+    slots = threading.Semaphore(opts.pool_size) if limiter is None else None
+    in_flight = [0]
+    in_flight_cond = threading.Condition()
+
+    def finish_item(item, t2, errors, ok):
+        func, path, node, kwargs, role = item[:5]
+        key = run_q.cost_model.key(func, role)
+        t3 = time.time()
+        TRACER.add(key, 'item', t2, t3, role=role, osds=len(kwargs.get('osd_ids', ())),
+                   host=node, collector=key.split('.')[0], path=path)
+        run_q.done(item, t3 - t2)
+
+        if limiter is not None:
+            ok = ok and SSH_ERRORS.get(node) == errors
+            limiter.release(key, ok, (t3 - t2) / CostModel.units(kwargs))
+        else:
+            slots.release()
 
+        with in_flight_cond:
+            in_flight[0] -= 1
+            in_flight_cond.notify_all()
 
-def run_all(opts, run_q):
     def pool_thread():
-        val = run_q.get()
-        while val is not None:
+        while True:
+            t1 = time.time()
+            if limiter is not None:
+                limiter.acquire()
+            else:
+                slots.acquire()
+
+            if res_q is not None:
+                res_q.wait_not_full()
+
+            item = run_q.get()
+            if item is None:
+                if limiter is not None:
+                    limiter.release()
+                else:
+                    slots.release()
+                return
+
+            with in_flight_cond:
+                in_flight[0] += 1
+
+            func, path, node, kwargs, role = item[:5]
+            key = run_q.cost_model.key(func, role)
+            t2 = time.time()
+            TRACER.add("wait for item", 'queue', t1, t2)
+            TRACER.set_context(host=node, collector=key.split('.')[0], path=path)
+            errors = SSH_ERRORS.get(node)
             try:
-                func, path, node, kwargs = val
-                func(path, node, **kwargs)
+                res = func(path, node, **kwargs)
             except Exception:
                 logger.exception("In worker thread")
-            val = run_q.get()
+                res = False
+            TRACER.set_context()
+
+            if isinstance(res, Completion):
+                res.add_callback(functools.partial(finish_item, item, t2, errors))
+            else:
+                finish_item(item, t2, errors, res is not False)
+
+    logger.debug("Run %s items with estimated cost %.1fs", run_q.qsize(), run_q.total_cost())
 
     running_threads = []
-    for i in range(opts.pool_size):
+    for i in range(min(opts.workers, opts.pool_size, run_q.qsize())):
         th = threading.Thread(target=pool_thread)
         th.daemon = True
         th.start()
         running_threads.append(th)
-        run_q.put(None)
 
-    while True:
-        time.sleep(0.01)
-        if all(not th.is_alive() for th in running_threads):
-            break
+    for th in running_threads:
+        if DEADLINE is None:
+            th.join()
+        else:
+            # commands are killed at deadline, so workers should finish soon after it
+            th.join(max(DEADLINE + DEADLINE_GRACE - time.time(), 0))
+
+    alive = sum(th.is_alive() for th in running_threads)
+    if alive != 0:
+        logger.warning("%s workers are still running after collection deadline, abandon them", alive)
+
+    # wait for items, finished by callbacks
+    with in_flight_cond:
+        while in_flight[0] > alive:
+            if DEADLINE is not None and time.time() >= DEADLINE + DEADLINE_GRACE:
+                logger.warning("%s items are still running after collection deadline, abandon them",
+                               in_flight[0] - alive)
+                break
+            in_flight_cond.wait(None if DEADLINE is None else max(DEADLINE + DEADLINE_GRACE - time.time(), 0.1))
+
+    if limiter is not None:
+        limiter.log()
+
+
+# worker threads only wait for ProcessReactor, so they don't need big stack
+REACTOR_THREAD_STACK_SIZE = 512 * 1024
+
+# default worker threads for reactor engine, node and resource items don't
+# keep them, so they only limit items, which wait for commands in thread
+REACTOR_WORKERS = 32
+
+
+def setup_engine(opts):
+    global REACTOR
+
+    # with adaptive concurrency pool size is initial and max limit
+    if opts.engine == 'reactor':
+        if opts.pool_size is None:
+            opts.pool_size = 256
+        if opts.workers is None:
+            opts.workers = REACTOR_WORKERS
+        threading.stack_size(REACTOR_THREAD_STACK_SIZE)
+        REACTOR = ProcessReactor()
+    else:
+        if opts.pool_size is None:
+            opts.pool_size = 16
+        if opts.workers is None:
+            opts.workers = opts.pool_size
+        REACTOR = None
 
 
 def setup_loggers(default_level=logging.INFO, log_fname=None):
@@ -642,6 +3906,20 @@ ALL_COLLECTORS = [
 ]
 
 
+def compress_opt(val):
+    "parse CODEC[:LEVEL] option"
+    codec, _, level = val.partition(':')
+    if codec not in ARCHIVE_CODECS:
+        raise argparse.ArgumentTypeError("Unknown codec {0!r}".format(codec))
+
+    if level == '':
+        return codec, ARCHIVE_CODECS[codec][1]
+
+    if not level.isdigit():
+        raise argparse.ArgumentTypeError("Compression level should be integer, not {0!r}".format(level))
+    return codec, int(level)
+
+
 def parse_args(argv):
     p = argparse.ArgumentParser()
     p.add_argument("-c", "--conf",
@@ -658,8 +3936,84 @@ def parse_args(argv):
                    help="Colsole log level")
 
     p.add_argument("-p", "--pool-size",
-                   default=16, type=int,
-                   help="Worker pool size")
+                   default=None, type=int,
+                   help="Max collection items in flight, adaptive concurrency starts from it " +
+                   "(default 256 for reactor engine and 16 for threads)")
+
+    p.add_argument("--workers", default=None, type=int,
+                   help="Worker threads (default {0} for reactor engine and pool size for threads). ".format(
+                       REACTOR_WORKERS) + "With reactor engine node and resource items don't keep " +
+                   "worker while their commands run, so only other items are limited by it")
+
+    p.add_argument("--no-adaptive", default=False,
+                   action="store_true",
+                   help="Run fixed count of items, ceph and ssh check commands in parallel, " +
+                   "instead of adapting it to observed latency and errors")
+
+    p.add_argument("--ssh-check-concurrency", default=32, type=int,
+                   help="Max count of hosts, checked for ssh availability in parallel")
+
+    p.add_argument("--engine", choices=["reactor", "threads"],
+                   default="reactor",
+                   help="Process execution engine: 'reactor' - one event loop for all " +
+                   "child processes, 'threads' - each worker thread blocks on own process")
+
+    p.add_argument("--ceph-backend", choices=["cli", "rados"],
+                   default="cli",
+                   help="How to run cluster queries: 'cli' - with ceph command line tool, " +
+                   "'rados' - over one librados connection (fallback to cli if python-rados is unusable)")
+
+    p.add_argument("--fake-rados", default=None, metavar="DIR",
+                   help="Use local fake responder instead of librados for 'rados' backend. " +
+                   "DIR is master folder of unpacked collect_info archive")
+
+    p.add_argument("--fake-rados-latency", default=0, type=float, metavar="SEC",
+                   help="Latency of each fake responder command")
+
+    p.add_argument("--master-concurrency",
+                   default=8, type=int,
+                   help="Max count of ceph cluster queries, running in parallel")
+
+    p.add_argument("--max-runtime", default=None, type=int, metavar="SEC",
+                   help="Finish collection in SEC seconds: kill running commands, " +
+                   "skip not started items and save everything collected")
+
+    p.add_argument("--cmd-timeout", default=300, type=int, metavar="SEC",
+                   help="Kill each remote command (with all its children) after SEC seconds")
+
+    p.add_argument("--host-caps-file",
+                   default=os.path.expanduser("~/.ceph_monitoring_host_caps.json"),
+                   help="File to keep available tools and sudo rights of hosts between runs")
+
+    p.add_argument("--host-caps-ttl", default=24 * 3600, type=int, metavar="SEC",
+                   help="Probe host capabilities again after SEC seconds")
+
+    p.add_argument("--no-host-caps", default=False,
+                   action="store_true",
+                   help="Don't probe hosts for available tools, run all commands")
+
+    p.add_argument("--compress-threshold", default=64 * 1024, type=int, metavar="BYTES",
+                   help="Gzip remote command output bigger than BYTES before transfer, " +
+                   "negative value disables compression")
+
+    p.add_argument("--host-max-failures", default=3, type=int, metavar="COUNT",
+                   help="Skip all following work on host after COUNT ssh connection failures in a row")
+
+    p.add_argument("--max-host-concurrency",
+                   default=2, type=int,
+                   help="Max count of collection items, running on one host at the same time")
+
+    p.add_argument("--costs-file",
+                   default=os.path.expanduser("~/.ceph_monitoring_costs.json"),
+                   help="File to keep collection items run time between runs, used to " +
+                   "start most expensive items first")
+
+    p.add_argument("--result-queue-mem", default=64 * 1024 ** 2, type=int, metavar="BYTES",
+                   help="Block collectors while results, waiting for archiving, take more than " +
+                   "BYTES of memory")
+
+    p.add_argument("--spill-threshold", default=4 * 1024 ** 2, type=int, metavar="BYTES",
+                   help="Keep outputs bigger than BYTES in temporary files till archived")
 
     p.add_argument("-t", "--ssh-conn-timeout",
                    default=60, type=int,
@@ -677,7 +4031,26 @@ def parse_args(argv):
                    nargs='*', help="Disable collect pattern")
 
     p.add_argument("--ceph-log-max-lines", default=1000,
-                   type=int, help="Max lines from osd/mon log")
+                   type=int, help="Max lines from osd/mon log, if it wasn't collected before")
+
+    p.add_argument("--ceph-log-max-bytes", default=64 * 1024 ** 2, type=int, metavar="BYTES",
+                   help="Max bytes of new osd/mon log data")
+
+    p.add_argument("--log-offsets-file",
+                   default=os.path.expanduser("~/.ceph_monitoring_log_offsets.json"),
+                   help="File to keep sizes of remote logs between runs, to fetch only new lines")
+
+    p.add_argument("--log-offsets", default=False,
+                   action="store_true",
+                   help="Fetch only log lines, added since the previous run, instead of last " +
+                   "--ceph-log-max-lines lines. Archive logs aren't self-contained in this mode")
+
+    p.add_argument("--log-filter", default=[], action="append", metavar="REGEXP",
+                   help="Fetch only log lines, matching extended REGEXP, e.g. 'slow request'. " +
+                   "Lines matching any of filters or --log-severity are fetched")
+
+    p.add_argument("--log-severity", default=None, choices=sorted(LOG_SEVERITY_PATTERNS),
+                   help="Fetch only log lines with given or higher cluster log severity")
 
     p.add_argument("--collectors", default="ceph,node,resource,performance",
                    help="Coma separated list of collectors" +
@@ -688,15 +4061,52 @@ def parse_args(argv):
                    type=int,
                    help="maximum PG count to by dumped with 'pg dump' cmd")
 
-    p.add_argument("-o", "--result", default=None, help="Result file")
+    p.add_argument("-o", "--result", default=None,
+                   help="Result file, '-' to write archive to stdout")
+
+    p.add_argument("--compress", default="gzip", type=compress_opt, metavar="CODEC[:LEVEL]",
+                   help="Archive compression, CODEC is one of " + ",".join(sorted(ARCHIVE_CODECS)) +
+                   ", default level is codec default")
+
+    p.add_argument("--compress-threads", default=multiprocessing.cpu_count(), type=int,
+                   help="Threads to compress archive blocks in parallel (default - cpu count)")
+
+    p.add_argument("--incremental-from", default=None, metavar="PREV_ARCHIVE",
+                   help="Don't collect and store results, which are the same as in PREV_ARCHIVE. " +
+                   "Result is a delta archive, visualize it with PREV_ARCHIVE as --base")
 
     p.add_argument("-n", "--dont-remove-unpacked", default=False,
                    action="store_true",
-                   help="Keep unpacked data")
+                   help="Also save unpacked data into temporary folder")
 
     p.add_argument("-j", "--no-pretty-json", default=False,
                    action="store_true",
-                   help="Don't prettify json data")
+                   help="Store json data as received, readers prettify it on read")
+
+    p.add_argument("--writer-threads", default=multiprocessing.cpu_count(), type=int,
+                   help="Threads to prettify and archive results (default - cpu count)")
+
+    p.add_argument("--agent", default=False,
+                   action="store_true",
+                   help="Collect per-host data with python agent, started once on each host")
+
+    p.add_argument("--relay-by", default=None, choices=["rack", "row"],
+                   help="Collect hosts of each CRUSH rack or row by this script, started on one of " +
+                   "them, which needs ssh access to other hosts of the bucket")
+
+    p.add_argument("--relay-min-hosts", default=8, type=int, metavar="COUNT",
+                   help="Collect buckets with less than COUNT hosts directly")
+
+    p.add_argument("--relay-plan", default=None, metavar="JSON",
+                   help=argparse.SUPPRESS)
+
+    p.add_argument("--no-batch", default=False,
+                   action="store_true",
+                   help="Run each remote command in separated ssh session")
+
+    p.add_argument("--no-ssh-pool", default=False,
+                   action="store_true",
+                   help="Don't keep persistent multiplexed ssh connection to each host")
 
     return p.parse_args(argv[1:])
 
@@ -704,24 +4114,40 @@ def parse_args(argv):
 logger_ready = False
 
 
-def prun(runs, thcount):
+def prun(runs, thcount, limiter=None):
+    """run (func, args, kwargs) from runs in thcount threads, returns [(ok, result or exception)]
+    limiter - AIMDLimiter to adapt count of parallel runs, runs of the same func are the same
+    kind of work for it. Exception, returned None or (False, out) is a failure for limiter"""
     res_q = Queue.Queue()
     input_q = Queue.Queue()
     map(input_q.put, enumerate(runs))
 
     def worker():
         while True:
+            if limiter is not None:
+                limiter.acquire()
+
             try:
                 pos, (func, args, kwargs) = input_q.get(False)
             except Queue.Empty:
+                if limiter is not None:
+                    limiter.release()
                 return
 
+            t1 = time.time()
+            errors = SSH_ERRORS.get()
             try:
-                res_q.put((pos, True, func(*args, **kwargs)))
+                res = func(*args, **kwargs)
+                res_q.put((pos, True, res))
+                ok = res is not None and not (isinstance(res, tuple) and len(res) == 2 and res[0] is False)
             except Exception as exc:
                 res_q.put((pos, False, exc))
+                ok = False
+
+            if limiter is not None:
+                limiter.release(func.__name__, ok and SSH_ERRORS.get() == errors, time.time() - t1)
 
-    ths = [threading.Thread(target=worker) for i in range(thcount)]
+    ths = [threading.Thread(target=worker) for i in range(min(thcount, len(runs)))]
 
     for th in ths:
         th.daemon = True
@@ -730,6 +4156,9 @@ def prun(runs, thcount):
     for th in ths:
         th.join()
 
+    if limiter is not None:
+        limiter.log()
+
     results = []
     while not res_q.empty():
         results.append(res_q.get())
@@ -737,45 +4166,106 @@ def prun(runs, thcount):
     return [(ok, val) for _, ok, val in sorted(results)]
 
 
-def pmap(func, data, thcount):
-    return prun([(func, [val], {}) for val in data], thcount)
+def pmap(func, data, thcount, limiter=None):
+    return prun([(func, [val], {}) for val in data], thcount, limiter)
 
 
-def get_sshable_hosts(hosts, thcount=32):
-    cmd = "ssh -o LogLevel=quiet -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=60 -o ConnectionAttempts=2 "
+def get_sshable_hosts(hosts, thcount=32, ssh_pool=None, host_caps=None, limiter=None):
+    "returns hosts, available over ssh, probes capabilities of hosts if host_caps is given"
+    ssh_opts = "-o LogLevel=quiet -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " + \
+               "-o ConnectTimeout=60 -o ConnectionAttempts=2"
 
     def check_host(host):
         try:
             socket.gethostbyname(host)
         except socket.gaierror:
             return None
-        ok, out = check_output(cmd + host + ' pwd')
+
+        probe = host_caps is not None and host_caps.need_probe(host)
+        cmd = HostCapabilities.probe_cmd if probe else 'pwd'
+
+        if ssh_pool is not None:
+            ok, out = ssh_pool.open(host, ssh_opts, cmd)
+        else:
+            ok, out = check_output("ssh {0} {1} {2}".format(ssh_opts, host, cmd))
+
         if ok:
+            if probe:
+                host_caps.add_probe_result(host, out)
             return host
         return None
 
-    results = pmap(check_host, hosts, thcount=thcount)
+    results = pmap(check_host, hosts, thcount=thcount, limiter=limiter)
     return [res for ok, res in results if ok and res is not None]
 
 
 def main(argv):
-    if not check_output('which ceph')[0]:
+    # TODO: Logs from down OSD
+    opts = parse_args(argv)
+
+    # relays collect hosts only, without ceph queries
+    if opts.relay_plan is None and not check_output('which ceph')[0]:
         logger.error("No 'ceph' command available. Run this script from node, which has ceph access")
         return
 
-    # TODO: Logs from down OSD
-    opts = parse_args(argv)
-    res_q = Queue.Queue()
-    run_q = Queue.Queue()
+    global DEADLINE
+    if opts.max_runtime is not None:
+        DEADLINE = time.time() + opts.max_runtime
+
+    # big outputs are kept on disk till archived
+    spill_dir = tempfile.mkdtemp(prefix="ceph_monitoring_spill_")
+    res_q = ResultQueue(opts.result_queue_mem, opts.spill_threshold, spill_dir)
+    cost_model = CostModel(opts.costs_file)
+    run_q = CollectScheduler(cost_model, opts.max_host_concurrency)
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        out_folder = os.tempnam()
+    codec, level = opts.compress
+    try:
+        compress_block = get_block_compressor(codec, level)
+    except ValueError as exc:
+        logger.error("%s", exc)
+        return 1
+
+    global INCREMENTAL_BASE
+    if opts.incremental_from is not None:
+        try:
+            INCREMENTAL_BASE = IncrementalBase(opts.incremental_from)
+        except (ValueError, KeyError) as exc:
+            logger.error("Can't use %r as base of incremental run: %s", opts.incremental_from, exc)
+            return 1
+
+    if opts.result == '-':
+        out_file = None
+        result_fd = sys.stdout
+    else:
+        if opts.result is None:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                out_file = os.tempnam() + ".tar." + ARCHIVE_CODECS[codec][0]
+        else:
+            out_file = opts.result
+        result_fd = open(out_file, "wb")
+
+    if opts.dont_remove_unpacked:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            out_folder = os.tempnam()
+        os.makedirs(out_folder)
+    else:
+        out_folder = None
+
+    # pool is forked before any thread is started and any pipe is opened
+    if opts.writer_threads > 1 and not opts.no_pretty_json:
+        json_pool = JSONPool(opts.writer_threads)
+    else:
+        json_pool = None
 
-    os.makedirs(out_folder)
+    compressor = ParallelCompressor(result_fd, compress_block, opts.compress_threads)
+    writer = ArchiveWriter(compressor, out_folder)
 
-    setup_loggers(getattr(logging, opts.log_level),
-                  os.path.join(out_folder, "log.txt"))
+    # log is added to archive at the end
+    log_fd, log_fname = tempfile.mkstemp(prefix="ceph_monitoring_", suffix=".log")
+    os.close(log_fd)
+    setup_loggers(getattr(logging, opts.log_level), log_fname)
 
     global logger_ready
     logger_ready = True
@@ -783,6 +4273,22 @@ def main(argv):
     global SSH_OPTS
     SSH_OPTS = SSH_OPTS.format(opts.ssh_conn_timeout)
 
+    global SSH_POOL
+    global CEPH_BACKEND
+    global HOST_BREAKER
+    global HOST_CAPS
+    global LOG_OFFSETS
+
+    setup_engine(opts)
+    HOST_BREAKER = HostCircuitBreaker(opts.host_max_failures)
+    if not opts.no_host_caps:
+        HOST_CAPS = HostCapabilities(opts.host_caps_file, opts.host_caps_ttl)
+    if opts.log_offsets:
+        LOG_OFFSETS = LogOffsets(opts.log_offsets_file)
+    if opts.relay_plan is None:
+        CEPH_BACKEND = make_ceph_backend(opts)
+        logger.info("Use %r backend for ceph queries", CEPH_BACKEND.name)
+
     collector_settings = CollectSettings()
     map(collector_settings.disable, opts.disable)
 
@@ -815,75 +4321,155 @@ def main(argv):
     else:
         ceph_performance_collector = None
 
-    nodes = discover_nodes(opts)
-    nodes['master'][None] = [{}]
+    if opts.agent:
+        agent_collector = RemoteAgentCollector(opts, collector_settings, res_q,
+                                               node_collector, ceph_collector,
+                                               node_resource_collector)
+    else:
+        agent_collector = None
+
+    if opts.relay_plan is None:
+        nodes, discovered = discover_nodes(opts)
+        nodes['master'][None] = [{'discovered': discovered}]
+    else:
+        nodes = collections.defaultdict(lambda: {})
+        for role, role_nodes in json.loads(opts.relay_plan).items():
+            nodes[str(role)] = {str(host): [{str(key): val for key, val in kwargs.items()} for kwargs in args]
+                                for host, args in role_nodes.items()}
 
     for role, nodes_with_args in nodes.items():
         if role == 'node':
             continue
         logger.info("Found %s hosts with role %s", len(nodes_with_args), role)
+        # osd services are grouped per host
         logger.info("Found %s services with role %s",
-                    sum(map(len, nodes_with_args.values())), role)
+                    sum(len(kwargs.get('osd_ids', [kwargs]))
+                        for kwargs_list in nodes_with_args.values()
+                        for kwargs in kwargs_list),
+                    role)
 
     logger.info("Found %s hosts total", len(nodes['node']))
 
-    good_hosts = set(get_sshable_hosts(nodes['node'].keys()))
+    if not opts.no_ssh_pool:
+        SSH_POOL = SSHConnectionPool()
+
+    relays = {}
+    relay_collector = None
+    if opts.relay_by is not None and opts.relay_plan is None:
+        source = relay_source()
+        if source is None:
+            logger.error("Relays need this script to be run from file, collect all hosts directly")
+        else:
+            relays = plan_relays(opts, nodes, discovered)
+            relay_collector = RelayCollector(opts, collector_settings, res_q, source, spill_dir)
+
+    for bucket, (relay, plan) in relays.items():
+        for role_nodes in nodes.values():
+            for host in plan['node']:
+                role_nodes.pop(host, None)
+
+    if len(relays) != 0:
+        logger.info("%s hosts would be collected by %s relays", sum(len(plan['node']) for _, plan in relays.values()),
+                    len(relays))
+
+    good_hosts = set(get_sshable_hosts(nodes['node'].keys(), opts.ssh_check_concurrency,
+                                       ssh_pool=SSH_POOL, host_caps=HOST_CAPS,
+                                       limiter=make_limiter(opts, "SSH check", opts.ssh_check_concurrency)))
     bad_hosts = set(nodes['node'].keys()) - good_hosts
 
     if len(bad_hosts) != 0:
         logger.warning("Next hosts aren't awailable over ssh and would be skipped: %s",
                        ",".join(bad_hosts))
 
-    res_q.put((True, "bad_hosts", 'json', json.dumps(list(bad_hosts))))
+    def only_good(nodes, good_hosts):
+        new_nodes = collections.defaultdict(lambda: {})
 
-    new_nodes = collections.defaultdict(lambda: {})
+        for role, role_objs in nodes.items():
+            if role == 'master':
+                new_nodes[role] = role_objs
+            else:
+                for node, args in role_objs.items():
+                    if node in good_hosts:
+                        new_nodes[role][node] = args
 
-    for role, role_objs in nodes.items():
-        if role == 'master':
-            new_nodes[role] = role_objs
-        else:
-            for node, args in role_objs.items():
-                if node in good_hosts:
-                    new_nodes[role][node] = args
+        return new_nodes
+
+    def put_collect_items(nodes):
+        if agent_collector is not None:
+            # agent collects node, osd and first resource usage data in one run
+            for node, _ in nodes['node'].items():
+                osd_ids = [osd_id for kwargs in nodes['osd'].get(node, []) for osd_id in kwargs['osd_ids']]
+                run_q.put(agent_collector.collect_node, "", node, {'osd_ids': osd_ids}, 'node')
+        elif node_resource_collector is not None:
+            # collect data at the beginning
+            for node, _ in nodes['node'].items():
+                run_q.put(node_resource_collector.collect_node, "", node, {}, 'node')
 
-    nodes = new_nodes
+        for role, nodes_with_args in nodes.items():
+            for collector in collectors:
+                if agent_collector is not None and agent_collector.replaces(collector, role):
+                    continue
 
-    # collect data at the beginning
-    if node_resource_collector is not None:
-        for node, _ in nodes['node'].items():
-            run_q.put((node_resource_collector.collect_node, "", node, {}))
+                if hasattr(collector, 'collect_' + role):
+                    coll_func = getattr(collector, 'collect_' + role)
+                    for node, kwargs_list in nodes_with_args.items():
+                        for kwargs in kwargs_list:
+                            run_q.put(coll_func, "", node, kwargs, role)
 
-    for role, nodes_with_args in nodes.items():
-        for collector in collectors:
-            if hasattr(collector, 'collect_' + role):
-                coll_func = getattr(collector, 'collect_' + role)
-                for node, kwargs_list in nodes_with_args.items():
-                    for kwargs in kwargs_list:
-                        run_q.put((coll_func, "", node, kwargs))
-
-    save_results_thread = threading.Thread(target=save_results_th_func,
-                                           args=(opts, res_q, out_folder))
-    save_results_thread.daemon = True
-    save_results_thread.start()
+    nodes = only_good(nodes, good_hosts)
+
+    for bucket, (relay, plan) in relays.items():
+        run_q.put(relay_collector.collect_relay, "", relay, {'bucket': bucket, 'plan': plan}, 'relay')
+
+    put_collect_items(nodes)
+
+    writer.add("json_format.txt", "raw" if opts.no_pretty_json else "pretty")
+    write_stats = WriteStats()
+    manifest = ResultManifest(INCREMENTAL_BASE)
+    save_results_threads = [threading.Thread(target=save_results_th_func,
+                                             args=(opts, res_q, writer, write_stats, manifest, json_pool))
+                            for _ in range(max(opts.writer_threads, 1))]
+    for th in save_results_threads:
+        th.daemon = True
+        th.start()
 
     t1 = time.time()
     try:
-        run_all(opts, run_q)
+        run_all(opts, run_q, res_q)
+
+        if relay_collector is not None and len(relay_collector.failed) != 0:
+            failed_nodes = collections.defaultdict(lambda: {})
+            for plan in relay_collector.failed.values():
+                for role, role_nodes in plan.items():
+                    failed_nodes[role].update(role_nodes)
+
+            failed_good_hosts = set(get_sshable_hosts(failed_nodes['node'].keys(), opts.ssh_check_concurrency,
+                                                      ssh_pool=SSH_POOL, host_caps=HOST_CAPS))
+            bad_hosts.update(set(failed_nodes['node'].keys()) - failed_good_hosts)
+
+            failed_nodes = only_good(failed_nodes, failed_good_hosts)
+            logger.info("Collect %s hosts of failed relays directly", len(failed_nodes['node']))
+            put_collect_items(failed_nodes)
+            run_all(opts, run_q, res_q)
+
+            for role, role_nodes in failed_nodes.items():
+                nodes[role].update(role_nodes)
 
         # collect data at the end
         if node_resource_collector is not None:
-            dt = opts.usage_collect_interval - (time.time() - t1)
+            dt = limit_timeout(opts.usage_collect_interval - (time.time() - t1))
             if dt > 0:
                 logger.info("Will wait for {0} seconds for usage data collection".format(int(dt)))
                 for i in range(int(dt / 0.1)):
                     time.sleep(0.1)
             logger.info("Start final usage collection")
             for node, _ in nodes['node'].items():
-                run_q.put((node_resource_collector.collect_node, "", node, {}))
-            run_all(opts, run_q)
+                run_q.put(node_resource_collector.collect_node, "", node, {}, 'node')
+            run_all(opts, run_q, res_q)
 
         if ceph_performance_collector is not None:
             logger.info("Start performace monitoring.")
+            PROCESS_SNAPSHOTS.reset()
             with ceph_collector.osd_devs_lock:
                 osd_devs = ceph_collector.osd_devs.copy()
 
@@ -893,45 +4479,94 @@ def main(argv):
 
             # start monitoring
             for node, data in per_node.items():
-                run_q.put((ceph_performance_collector.start_performance_monitoring,
-                          "", node, {'osd_devs': data}))
-            run_all(opts, run_q)
+                run_q.put(ceph_performance_collector.start_performance_monitoring,
+                          "", node, {'osd_devs': data}, 'node')
+            run_all(opts, run_q, res_q)
 
-            dt = opts.performance_collect_seconds
+            dt = limit_timeout(opts.performance_collect_seconds)
             logger.info("Will wait for {0} seconds for performance data collection".format(int(dt)))
             for i in range(int(dt / 0.1)):
                 time.sleep(0.1)
 
             # collect results
             for node, data in per_node.items():
-                run_q.put((ceph_performance_collector.collect_performance_data,
-                          "", node, {}))
-            run_all(opts, run_q)
+                run_q.put(ceph_performance_collector.collect_performance_data,
+                          "", node, {}, 'node')
+            run_all(opts, run_q, res_q)
     except Exception:
         logger.exception("When collecting data:")
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, save already collected data")
     finally:
+        # result must be saved anyway
+        DEADLINE = None
+
+        skipped = [{'item': cost_model.key(func, role), 'node': node,
+                    'estimated_cost': cost, 'reason': reason}
+                   for (func, _, node, _, role, cost), reason in run_q.skipped]
+
+        if relay_collector is not None:
+            bad_hosts.update(relay_collector.bad_hosts)
+            skipped.extend(relay_collector.skipped)
+
+        res_q.put((True, "bad_hosts", 'json', json.dumps(list(bad_hosts))))
+        if len(skipped) != 0:
+            res_q.put((True, "skipped_items", 'json', json.dumps(skipped)))
+
+        if SSH_POOL is not None:
+            SSH_POOL.close()
+
+        if CEPH_BACKEND is not None:
+            CEPH_BACKEND.close()
+        cost_model.save()
+        if HOST_CAPS is not None:
+            HOST_CAPS.save()
+        if LOG_OFFSETS is not None:
+            LOG_OFFSETS.save()
+
+        TRANSFER_STATS.log()
+        REMOTE_USAGE.log()
+        res_q.put((True, "collection_cost", 'json', REMOTE_USAGE.dumps()))
+
         res_q.put(None)
         # wait till all data collected
-        save_results_thread.join()
-
-    if opts.result is None:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            out_file = os.tempnam() + ".tar.gz"
+        for th in save_results_threads:
+            th.join()
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+        if json_pool is not None:
+            json_pool.close()
+
+        res_q.log()
+        write_stats.log()
+        manifest.log()
+        TRACER.log_summary()
+        # ru_maxrss is in KiB on linux
+        logger.info("Peak memory usage: %s MiB",
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
+
+    if out_file is not None:
+        logger.info("Result saved into %r", out_file)
     else:
-        out_file = opts.result
+        logger.info("Result written to stdout")
 
-    check_output("cd {0} ; tar -zcvf {1} *".format(out_folder, out_file))
-    logger.info("Result saved into %r", out_file)
-    if opts.log_level in ('WARNING', 'ERROR', "CRITICAL"):
-        print "Result saved into %r" % (out_file,)
+    writer.add(MANIFEST_NAME, manifest.dumps())
+    writer.add("trace.json", TRACER.dumps())
+    writer.add("log.txt", open(log_fname, "rb").read())
+    writer.close()
+    os.unlink(log_fname)
 
-    if not opts.dont_remove_unpacked:
-        shutil.rmtree(out_folder)
-    else:
-        logger.info("Temporary folder %r", out_folder)
+    if out_file is not None:
+        result_fd.close()
         if opts.log_level in ('WARNING', 'ERROR', "CRITICAL"):
-            print "Temporary folder %r" % (out_folder,)
+            print "Result saved into %r" % (out_file,)
+    else:
+        result_fd.flush()
+
+    if out_folder is not None:
+        logger.info("Unpacked data in %r", out_folder)
+        if opts.log_level in ('WARNING', 'ERROR', "CRITICAL") and out_file is not None:
+            print "Unpacked data in %r" % (out_folder,)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import sys
+import cgi
 import json
 import shutil
 import pprint
@@ -827,6 +828,40 @@ def show_hosts_resource_usage(report, cluster):
     report.add_block(12, "Host's resource usage:", table)
 
 
+def show_collection_cost(report, cluster, top=20):
+    if cluster.collection_cost is None:
+        return
+
+    def add_totals(table, name, totals):
+        table.add_cell(name)
+        table.add_cell(str(totals['count']))
+        table.add_cell("{0:.1f}".format(totals['cpu_ms'] / 1000.0),
+                       sorttable_customkey=str(totals['cpu_ms']))
+        if totals['max_rss_kb'] is None:
+            table.add_cell('-')
+        else:
+            table.add_cell(b2ssize(totals['max_rss_kb'] * 1024, False),
+                           sorttable_customkey=str(totals['max_rss_kb']))
+        table.add_cell(b2ssize(totals['read_bytes'], False),
+                       sorttable_customkey=str(totals['read_bytes']))
+        table.add_cell(b2ssize(totals['write_bytes'], False),
+                       sorttable_customkey=str(totals['write_bytes']))
+        table.next_row()
+
+    headers = ["Runs", "CPU, s", "Max RSS", "Disk read", "Disk write"]
+
+    table = html2.HTMLTable(headers=["Host"] + headers)
+    for host, totals in sorted(cluster.collection_cost['hosts'].items()):
+        add_totals(table, host, totals)
+    report.add_block(6, "Collection cost per host:", table)
+
+    table = html2.HTMLTable(headers=["Command"] + headers)
+    commands = sorted(cluster.collection_cost['commands'].items(), key=lambda x: -x[1]['cpu_ms'])
+    for cmd, totals in commands[:top]:
+        add_totals(table, cgi.escape(cmd), totals)
+    report.add_block(6, "Most expensive collection commands:", table)
+
+
 def get_io_resource_usage(cluster):
     writes_per_dev = {}
     reads_per_dev = {}
@@ -1149,10 +1184,55 @@ def parse_args(argv):
                    action="store_true")
     p.add_argument("--profile", help="Don't draw OSD graphs", default=False,
                    action="store_true")
+    p.add_argument("-b", "--base", default=[], action="append",
+                   help="Base archive of incremental data archive, repeat for chain of " +
+                   "incremental runs, oldest first")
     p.add_argument("data_folder", help="Folder with data, or .tar.gz archive")
     return p.parse_args(argv[1:])
 
 
+# archive compression magic bytes and command to decompress it to stdout
+ARCHIVE_MAGICS = [
+    ('\x1f\x8b', 'gzip -dc'),
+    ('\xfd7zXZ\x00', 'xz -dc'),
+    ('\x28\xb5\x2f\xfd', 'zstd -dc'),
+    ('\x04\x22\x4d\x18', 'lz4 -dc'),
+]
+
+
+def unpack_archive(arch_name, folder):
+    "unpack collect_info archive, compressed with any supported codec, or plain tar"
+    magic = open(arch_name, 'rb').read(6)
+    for prefix, decompress_cmd in ARCHIVE_MAGICS:
+        if magic.startswith(prefix):
+            break
+    else:
+        decompress_cmd = 'cat'
+
+    subprocess.call("{0} {1} | tar -xvf - -C {2} >/dev/null 2>&1".format(decompress_cmd, arch_name, folder),
+                    shell=True)
+
+
+# archive members, which aren't results of collection
+ARCHIVE_META = ('manifest.json', 'json_format.txt', 'log.txt', 'trace.json')
+
+
+def apply_manifest(folder):
+    """Remove results of base archives, which delta archive doesn't have, as manifest of
+    the last overlaid archive lists all results of its run. Returns count of results, which
+    data wasn't found in given archives"""
+    manifest = json.load(open(os.path.join(folder, 'manifest.json')))
+    files = manifest['files']
+
+    for root, _, fnames in os.walk(folder):
+        for fname in fnames:
+            rel_path = os.path.relpath(os.path.join(root, fname), folder)
+            if rel_path not in files and rel_path not in ARCHIVE_META:
+                os.unlink(os.path.join(root, fname))
+
+    return sum(1 for rel_path in files if not os.path.exists(os.path.join(folder, rel_path)))
+
+
 def main(argv):
     opts = parse_args(argv)
     remove_folder = False
@@ -1164,7 +1244,18 @@ def main(argv):
             folder = os.tempnam()
             os.makedirs(folder)
             remove_folder = True
-            subprocess.call("tar -zxvf {0} -C {1} >/dev/null 2>&1".format(arch_name, folder), shell=True)
+            # delta archive is overlaid on its bases
+            for base_name in opts.base:
+                unpack_archive(base_name, folder)
+            unpack_archive(arch_name, folder)
+
+        if len(opts.base) != 0:
+            missing = apply_manifest(folder)
+            if missing != 0:
+                print "Warning: data of {0} results not found, pass all base archives".format(missing)
+    elif len(opts.base) != 0:
+        print "Base archives can be used only with data archive, not folder"
+        return 1
     else:
         folder = opts.data_folder
 
@@ -1172,6 +1263,11 @@ def main(argv):
         print "First argument should be a folder with data or path to archive"
         return 1
 
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if len(opts.base) == 0 and os.path.exists(manifest_path) and \
+            json.load(open(manifest_path)).get('base_run_id') is not None:
+        print "Warning: incremental data archive, pass its base archives with --base for full report"
+
     index_path = os.path.join(opts.out, 'index.html')
     if os.path.exists(index_path):
         if not opts.overwrite:
@@ -1227,6 +1323,9 @@ def main(argv):
         show_hosts_resource_usage(report, cluster)
         report.next_line()
 
+        show_collection_cost(report, cluster)
+        report.next_line()
+
         if not opts.no_graph:
             tree_to_visjs(report, cluster)
 
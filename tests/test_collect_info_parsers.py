@@ -0,0 +1,219 @@
+"""Parsers of remote output in collect_info, run with: python2 -m unittest discover -s tests"""
+import os
+import sys
+import json
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ceph_monitoring'))
+
+import collect_info
+
+
+MARKER = "0123456789abcdef"
+
+
+def frame(idx, code, out, err="", orig_sz=0):
+    "one command output in batch format"
+    return "{0} {1} {2} {3} {4} {5} 10 -1 0 0\n{6}{7}".format(MARKER, idx, code, len(out), len(err),
+                                                             orig_sz, out, err)
+
+
+def gzip_data(data):
+    cobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return cobj.compress(data) + cobj.flush()
+
+
+class BatchOutputTest(unittest.TestCase):
+    cmds = ["uname", "cat /proc/meminfo", "ls /nope"]
+    no_output = (False, "No output")
+
+    def parse(self, data, known_md5=None):
+        results = [self.no_output] * len(self.cmds)
+        collect_info.parse_batch_output("host", self.cmds, known_md5, 10, MARKER, data, results)
+        return results
+
+    def test_frames(self):
+        packed = gzip_data("memory\n")
+        cases = [
+            # (batch output, expected results)
+            ("", [self.no_output] * 3),
+            (frame(0, 0, "Linux\n"), [(True, "Linux\n"), self.no_output, self.no_output]),
+            (frame(2, 2, "", "no such file\n") + frame(0, 0, "Linux\n"),
+             [(True, "Linux\n"), self.no_output, (False, "no such file\n")]),
+            (frame(1, 0, packed, orig_sz=7), [self.no_output, (True, "memory\n"), self.no_output]),
+            (frame(1, 0, "not gzip", orig_sz=7), None),
+        ]
+        for data, expected in cases:
+            results = self.parse(data)
+            if expected is None:
+                self.assertFalse(results[1][0])
+                self.assertIn("Can't decompress", results[1][1])
+            else:
+                self.assertEqual(results, expected, repr(data))
+
+    def test_timeout(self):
+        ok, out = self.parse(frame(0, collect_info.BATCH_TIMEOUT_CODE, "partial"))[0]
+        self.assertFalse(ok)
+        self.assertIn("Killed by timeout after 10s", out)
+
+    def test_broken_frames(self):
+        good = frame(0, 0, "Linux\n")
+        cases = [
+            # truncated frame: sizes point past the end of data
+            good + frame(1, 0, "memory\n")[:-3],
+            # oversized frame
+            good + "{0} 1 0 {1} 0 0 10 -1 0 0\nshort".format(MARKER, 2 ** 40),
+            # negative size
+            good + "{0} 1 0 -5 0 0 10 -1 0 0\nx".format(MARKER),
+            # command index out of range
+            good + frame(7, 0, "x"),
+            # not a number in header
+            good + "{0} 1 0 x 0 0 10 -1 0 0\n".format(MARKER),
+            # wrong marker and wrong field count
+            good + frame(1, 0, "x").replace(MARKER, "f" * len(MARKER)),
+            good + "{0} 1 0 1 0\nx".format(MARKER),
+            # header without end of line
+            good + "{0} 1 0 1 0 0 10 -1 0 0".format(MARKER),
+        ]
+        for data in cases:
+            self.assertEqual(self.parse(data), [(True, "Linux\n"), self.no_output, self.no_output], repr(data))
+
+    def test_unchanged(self):
+        data = frame(0, 0, "", orig_sz=-1)
+        ok, out = self.parse(data, known_md5=["abc", None, None])[0]
+        self.assertTrue(ok)
+        self.assertIsInstance(out, collect_info.UnchangedResult)
+        self.assertEqual(out.md5, "abc")
+
+        # remote side can't report unchanged output, which md5 wasn't sent
+        for known_md5 in (None, [None, None, None]):
+            self.assertFalse(self.parse(data, known_md5=known_md5)[0][0])
+
+
+class ProcessSnapshotTest(unittest.TestCase):
+    def test_osd_ids(self):
+        cases = [
+            # (ps args, daemon, osd_id)
+            ("/usr/bin/ceph-osd -f --cluster ceph --id 3 --setuser ceph", 'osd', 3),
+            ("/usr/bin/ceph-osd -f --id=12", 'osd', 12),
+            ("/usr/bin/ceph-osd -i 5 -f", 'osd', 5),
+            ("/usr/bin/ceph-osd -n osd.7 -f", 'osd', 7),
+            ("/usr/bin/ceph-osd --name osd.8", 'osd', 8),
+            ("/usr/bin/ceph-osd -n client.admin", 'osd', None),
+            ("/usr/bin/ceph-osd --id", 'osd', None),
+            ("/usr/bin/ceph-osd --id=x", 'osd', None),
+            ("/usr/bin/ceph-osd --cluster 4", 'osd', None),
+            ("/usr/bin/ceph-mon -f --id node1", 'mon', None),
+            ("/usr/bin/radosgw -n client.rgw", 'rgw', None),
+            ("grep ceph-osd --id 3", None, None),
+        ]
+        ps_out = "  PID COMMAND\n" + "".join("{0} {1}\n".format(100 + num, args)
+                                             for num, (args, _, _) in enumerate(cases))
+        snapshot = collect_info.ProcessSnapshot(True, ps_out)
+        self.assertEqual(len(snapshot.processes), len(cases))
+        for proc, (args, daemon, osd_id) in zip(snapshot.processes, cases):
+            self.assertEqual((proc['daemon'], proc['osd_id']), (daemon, osd_id), args)
+
+        self.assertTrue(snapshot.osd_running(12))
+        self.assertFalse(snapshot.osd_running(4))
+        self.assertEqual(snapshot.daemons_text('mon'), "109 /usr/bin/ceph-mon -f --id node1\n")
+
+    def test_broken_lines(self):
+        snapshot = collect_info.ProcessSnapshot(True, "PID COMMAND\n\nxx ceph-osd --id 1\n42\n  7 ceph-osd -i 2\n")
+        self.assertEqual([(proc['pid'], proc['osd_id']) for proc in snapshot.processes], [(7, 2)])
+
+    def test_failed(self):
+        snapshot = collect_info.ProcessSnapshot(False, "ps: not found")
+        self.assertEqual((snapshot.processes, snapshot.error), ([], "ps: not found"))
+
+
+class HostDeviceIndexTest(unittest.TestCase):
+    scan_out = "\n".join([
+        "mount 22 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw",
+        "mount 30 22 8:1 / /var/lib/ceph/osd/ceph-0 rw - xfs /dev/sda1 rw",
+        "mount 31 22 8:17 / /var/lib/ceph/osd/ceph-1 rw - xfs /dev/sdb1 rw",
+        # later mount on the same point hides earlier one
+        "mount 32 22 8:33 / /var/lib/ceph/osd/ceph-1 rw - xfs /dev/sdc1 rw",
+        r"mount 33 22 8:1 / /mnt/with\040space rw - xfs /dev/sda1 rw",
+        "disk nvme0n1 259:0 - 0",
+        "part nvme0n1p2 259:2 nvme0n1 -",
+        "disk sda 8:0 - 1 sda1,",
+        "part sda1 8:1 sda - dm-0,dm-1,",
+        "disk sdb 8:16 - 1",
+        "part sdb1 8:17 sdb -",
+        "disk sdc 8:32 - 0",
+        "part sdc1 8:33 sdc -",
+        "garbage line",
+        "disk short",
+        "",
+    ])
+
+    def test_resolve(self):
+        index = collect_info.HostDeviceIndex(self.scan_out)
+        cases = [
+            # (path, dev, root_dev, is_ssd, holders), None if not on known device
+            ("/var/lib/ceph/osd/ceph-0", ('/dev/sda1', '/dev/sda', False, ['dm-0', 'dm-1'])),
+            ("/var/lib/ceph/osd/ceph-0/journal", ('/dev/sda1', '/dev/sda', False, ['dm-0', 'dm-1'])),
+            ("/var/lib/ceph/osd/ceph-1/current", ('/dev/sdc1', '/dev/sdc', True, [])),
+            ("/var/lib/ceph/osd/ceph-10", ('/dev/nvme0n1p2', '/dev/nvme0n1', True, [])),
+            ("/mnt/with space/file", ('/dev/sda1', '/dev/sda', False, ['dm-0', 'dm-1'])),
+            ("/dev/sdb1", ('/dev/sdb1', '/dev/sdb', False, [])),
+            ("/dev/nvme0n1", ('/dev/nvme0n1', '/dev/nvme0n1', True, [])),
+            ("/dev/unknown", None),
+        ]
+        for path, expected in cases:
+            info = index.resolve(path)
+            if expected is None:
+                self.assertIsNone(info, path)
+            else:
+                self.assertEqual((info['dev'], info['root_dev'], info['is_ssd'], info['holders']),
+                                 expected, path)
+
+    def test_empty(self):
+        index = collect_info.HostDeviceIndex("")
+        self.assertIsNone(index.resolve("/var/lib/ceph/osd/ceph-0"))
+
+
+class CrushBucketsTest(unittest.TestCase):
+    @staticmethod
+    def osd_tree(nodes):
+        return json.dumps({'nodes': [{'id': node_id, 'name': name, 'type': tp, 'children': children}
+                                     for node_id, name, tp, children in nodes]})
+
+    def test_buckets(self):
+        tree = self.osd_tree([
+            (-1, "default", "root", [-10, -20, -5]),
+            (-10, "row1", "row", [-11, -12]),
+            (-11, "rack1", "rack", [-2, -3]),
+            (-12, "rack2", "rack", [-4]),
+            (-20, "row2", "row", [-6]),
+            (-2, "host1", "host", [0]),
+            (-3, "host2", "host", [1]),
+            (-4, "host3", "host", [2]),
+            # host directly in root and host in row without rack
+            (-5, "host4", "host", [3]),
+            (-6, "host5", "host", [4]),
+            # host out of tree
+            (-7, "host6", "host", []),
+        ])
+        cases = [
+            ("rack", {"rack1": ["host1", "host2"], "rack2": ["host3"]}),
+            ("row", {"row1": ["host1", "host2", "host3"], "row2": ["host5"]}),
+            ("datacenter", {}),
+        ]
+        for bucket_type, expected in cases:
+            buckets = collect_info.crush_buckets(tree, bucket_type)
+            self.assertEqual({name: sorted(hosts) for name, hosts in buckets.items()}, expected, bucket_type)
+
+    def test_cycle(self):
+        tree = self.osd_tree([
+            (-1, "a", "root", [-2]),
+            (-2, "b", "datacenter", [-1, -3]),
+            (-3, "host1", "host", []),
+        ])
+        self.assertEqual(dict(collect_info.crush_buckets(tree, "rack")), {})
+
+
+if __name__ == "__main__":
+    unittest.main()